@@ -0,0 +1,398 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Route engine benchmark for the ICN Manager.
+Version 1.0
+
+Builds synthetic topologies in a temporary routers.db, drives the API
+through the Flask test client with a transport that only counts route
+operations, and reports per call latency, SQL statements and route
+operations:
+
+    python benchmark.py --layers 2,3 --routers 10,50 --prefixes 10,100 \
+        --output after.json --compare before.json
+
+With --fake-routers the batches are also applied to in-process routers
+(transport.FakeTransport), which reject them like ccndc -f does, and the
+FIB of every router is compared with the routes table after each run.
+"""
+
+from collections import OrderedDict
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+import routejobs
+import routercache
+import spatial
+import transport
+import webservice
+
+# Routers of the content source layer in every topology
+SOURCE_ROUTERS = 2
+SOURCE_LAYER = 100
+# Seconds to wait for the route job of a call to be applied
+JOB_TIMEOUT = 600
+# Results go to the temporary directory unless --output says otherwise, not into the checkout
+DEFAULT_OUTPUT = os.path.join(tempfile.gettempdir(), 'icnaas-benchmark.json')
+
+class StatementCounter(object):
+    """
+    Counts the statements executed on connections opened by one thread,
+    the one driving the test client, so route jobs are not counted.
+    """
+
+    def __init__(self):
+        self.thread = threading.current_thread()
+        self.reset()
+
+    def reset(self):
+        self.statements = 0
+        self.rows = 0
+
+    def count(self, rows):
+        self.statements += 1
+        self.rows += rows
+
+counter = StatementCounter()
+
+class CountingCursor(sqlite3.Cursor):
+
+    def execute(self, *args):
+        counter.count(1)
+        return sqlite3.Cursor.execute(self, *args)
+
+    def executemany(self, sql, parameters):
+        parameters = list(parameters)
+        counter.count(len(parameters))
+        return sqlite3.Cursor.executemany(self, sql, parameters)
+
+class CountingConnection(sqlite3.Connection):
+
+    def cursor(self, factory=CountingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+sqlite3_connect = sqlite3.connect
+
+def counting_connect(*args, **kwargs):
+    if threading.current_thread() is counter.thread:
+        kwargs['factory'] = CountingConnection
+    return sqlite3_connect(*args, **kwargs)
+
+class CountingTransport(object):
+    """
+    Accepts every push without contacting a router, counting the ccndc
+    commands by operation (add, del, setstrategy, removestrategy). With
+    routers (a FakeTransport) the pushes are applied to them too.
+    """
+
+    def __init__(self, routers=None):
+        self.routers = routers
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.pushes = 0
+            self.operations = {}
+
+    def push(self, host, commands):
+        with self.lock:
+            self.pushes += 1
+            for command in commands:
+                op = command.split(' ', 1)[0]
+                self.operations[op] = self.operations.get(op, 0) + 1
+        if self.routers is not None:
+            return self.routers.push(host, commands)
+
+    def read_fib(self, host):
+        if self.routers is not None:
+            return self.routers.read_fib(host)
+        return set()
+
+    def take(self):
+        with self.lock:
+            out = { 'pushes': self.pushes, 'operations': dict(self.operations) }
+        self.reset()
+        return out
+
+def router_ip(layer, index):
+    return '10.%d.%d.%d' % (layer, index // 250, index % 250 + 1)
+
+class Benchmark(object):
+    """
+    One topology, layers of routers_per_layer routers plus the source
+    layer, with prefixes, in its own database.
+    """
+
+    def __init__(self, layers, routers_per_layer, prefixes, repeat, transport):
+        self.layers = layers
+        self.routers_per_layer = routers_per_layer
+        self.prefixes = prefixes
+        self.repeat = repeat
+        self.transport = transport
+        self.directory = tempfile.mkdtemp(prefix='icnaas-benchmark')
+        self.client = None
+
+    def name(self):
+        return 'layers=%d routers=%d prefixes=%d' % (self.layers, self.routers_per_layer, self.prefixes)
+
+    def setup(self):
+        # a fresh database, and fresh in-memory views of it
+        webservice.DATABASE = os.path.join(self.directory, 'routers.db')
+        webservice.route_transport = self.transport
+        webservice.route_jobs = routejobs.RouteJobDispatcher(webservice.DATABASE,
+            webservice.push_router_commands, poll_interval=0.05)
+        webservice.router_cache = routercache.RouterCache(webservice.current_routers_version)
+        webservice.edge_index = spatial.EdgeRouterIndex()
+        webservice.init_db()
+        self.client = webservice.app.test_client()
+
+        routers = [{ 'public_ip': router_ip(layer, i), 'hostname': 'router-%d-%d' % (layer, i),
+            'coord_x': i, 'coord_y': layer, 'layer': layer, 'cell_id': i }
+            for layer in range(self.layers) for i in range(self.routers_per_layer)]
+        routers += [{ 'public_ip': router_ip(SOURCE_LAYER, i), 'hostname': 'source-%d' % i,
+            'layer': SOURCE_LAYER, 'cell_id': 0 } for i in range(SOURCE_ROUTERS)]
+        self.call('POST', '/icnaas/api/v1.0/routers/bulk', { 'routers': routers })
+        if self.prefixes:
+            self.call('POST', '/icnaas/api/v1.0/prefixes', { 'prefixes':
+                [{ 'url': 'ccnx:/benchmark/%d' % i, 'balancing': i % 2 } for i in range(self.prefixes)] })
+
+    def teardown(self):
+        webservice.route_jobs.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def call(self, method, url, data=None):
+        """
+        Send one request and wait for its route job. Returns the response
+        body and the measurements of the call.
+        """
+        counter.reset()
+        started = time.time()
+        response = self.client.open(url, method=method, data=json.dumps(data),
+            content_type='application/json')
+        latency = time.time() - started
+        statements, rows = counter.statements, counter.rows
+        if response.status_code not in (200, 201, 202):
+            raise RuntimeError('%s %s: %s %s' % (method, url, response.status_code, response.data))
+        body = json.loads(response.data)
+        pushed = time.time()
+        self.wait(body.get('job'))
+        out = { 'latency': latency, 'push': time.time() - pushed,
+            'statements': statements, 'rows': rows }
+        out.update(self.transport.take())
+        return body, out
+
+    def wait(self, job):
+        if job is None:
+            return
+        deadline = time.time() + JOB_TIMEOUT
+        conn = sqlite3_connect(webservice.DATABASE, timeout=routejobs.DATABASE_TIMEOUT)
+        try:
+            while time.time() < deadline:
+                state = routejobs.get_job(conn.cursor(), job['id'])['state']
+                conn.commit()
+                if state == routejobs.JOB_FAILED:
+                    raise RuntimeError('Route job %s failed' % job['id'])
+                if state not in (routejobs.JOB_QUEUED, routejobs.JOB_RUNNING):
+                    return
+                time.sleep(0.01)
+        finally:
+            conn.close()
+        raise RuntimeError('Route job %s not applied after %d seconds' % (job['id'], JOB_TIMEOUT))
+
+    def run(self):
+        """
+        Measure create_router, delete_router, create_prefix, update_prefix
+        and delete_prefix repeat times each. Every round leaves the topology
+        as it found it.
+        """
+        calls = OrderedDict((op, []) for op in ('create_router', 'delete_router',
+            'create_prefix', 'update_prefix', 'delete_prefix'))
+        # an inner layer, so the routers of the layer below are reprogrammed too
+        layer = min(1, self.layers - 1)
+        for i in range(self.repeat):
+            ip = router_ip(layer, self.routers_per_layer + i)
+            router = { 'public_ip': ip, 'hostname': 'extra-%d' % i, 'layer': layer, 'cell_id': i }
+            calls['create_router'].append(self.call('POST', '/icnaas/api/v1.0/routers', router)[1])
+            calls['delete_router'].append(self.call('DELETE', '/icnaas/api/v1.0/routers/' + ip)[1])
+
+            prefix = { 'url': 'ccnx:/extra/%d' % i, 'strategy': 'loadsharing' }
+            body, out = self.call('POST', '/icnaas/api/v1.0/prefixes', prefix)
+            calls['create_prefix'].append(out)
+            path = '/icnaas/api/v1.0/prefixes/%d' % body['prefix']['id']
+            prefix = { 'url': 'ccnx:/extra/%d/renamed' % i, 'strategy': 'parallel' }
+            calls['update_prefix'].append(self.call('PUT', path, prefix)[1])
+            calls['delete_prefix'].append(self.call('DELETE', path)[1])
+        return OrderedDict((op, summarize(results)) for op, results in calls.items())
+
+    def routes(self):
+        conn = sqlite3_connect(webservice.DATABASE)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM routes').fetchone()[0]
+        finally:
+            conn.close()
+
+    def verify(self):
+        """
+        Compare the FIB of every fake router with its routes in the
+        database, raising on the first router that differs.
+        """
+        conn = sqlite3_connect(webservice.DATABASE)
+        try:
+            rows = conn.execute('SELECT routes.router_ip, prefixes.url, routes.next_hop \
+                FROM routes JOIN prefixes ON prefixes.id = routes.prefix_id').fetchall()
+        finally:
+            conn.close()
+        expected = {}
+        for router_ip, url, next_hop in rows:
+            expected.setdefault(router_ip, set()).add((transport.normalize_uri(url), next_hop))
+        routers = self.transport.routers
+        for host in set(expected) | set(routers.routers):
+            fib = routers.read_fib(host)
+            if fib != expected.get(host, set()):
+                raise RuntimeError('FIB of %s differs from its routes: %d missing, %d extra' % (host,
+                    len(expected.get(host, set()) - fib), len(fib - expected.get(host, set()))))
+
+def summarize(results):
+    latencies = sorted(r['latency'] for r in results)
+    operations = {}
+    for r in results:
+        for op, n in r['operations'].items():
+            operations[op] = operations.get(op, 0) + n
+    n = float(len(results))
+    return OrderedDict([
+        ('calls', len(results)),
+        ('latency_min', latencies[0]),
+        ('latency_median', latencies[len(latencies) // 2]),
+        ('latency_max', latencies[-1]),
+        ('push_mean', sum(r['push'] for r in results) / n),
+        ('statements', sum(r['statements'] for r in results) / n),
+        ('rows', sum(r['rows'] for r in results) / n),
+        ('pushes', sum(r['pushes'] for r in results) / n),
+        ('operations', dict((op, count / n) for op, count in operations.items())),
+    ])
+
+def source_version():
+    # git revision of the manager, when run from a checkout
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline):
+    """
+    Print the change of median latency, statements and route operations
+    of every call measured in both results.
+    """
+    before = dict((s['name'], s['calls']) for s in baseline['scenarios'])
+    print('\nCompared with %s' % (baseline.get('version') or 'baseline'))
+    for scenario in results['scenarios']:
+        old = before.get(scenario['name'])
+        if old is None:
+            continue
+        for op, new in scenario['calls'].items():
+            if op not in old:
+                continue
+            ops_new = sum(new['operations'].values())
+            ops_old = sum(old[op]['operations'].values())
+            print('%-40s %-14s latency x%.2f  statements %+.1f  route ops %+.1f' % (scenario['name'], op,
+                new['latency_median'] / max(old[op]['latency_median'], 1e-9),
+                new['statements'] - old[op]['statements'], ops_new - ops_old))
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',')]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ICN Manager route engine benchmark')
+    parser.add_argument('--layers', type=parse_sizes, default=[2, 3],
+        help='comma separated numbers of router layers, besides the source layer')
+    parser.add_argument('--routers', type=parse_sizes, default=[5, 20, 50],
+        help='comma separated numbers of routers per layer')
+    parser.add_argument('--prefixes', type=parse_sizes, default=[10, 50],
+        help='comma separated numbers of prefixes')
+    parser.add_argument('--repeat', type=int, default=5, help='calls measured per operation')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+        help='file the results are saved to (default %(default)s)')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    parser.add_argument('--fake-routers', action='store_true',
+        help='apply the batches to in-process routers and check their FIBs')
+    args = parser.parse_args(argv)
+
+    sqlite3.connect = counting_connect
+    results = OrderedDict([
+        ('version', source_version()),
+        ('started', time.time()),
+        ('python', platform.python_version()),
+        ('sqlite', sqlite3.sqlite_version),
+        ('scenarios', []),
+    ])
+    try:
+        for layers in args.layers:
+            for routers in args.routers:
+                for prefixes in args.prefixes:
+                    fake = transport.FakeTransport() if args.fake_routers else None
+                    benchmark = Benchmark(layers, routers, prefixes, args.repeat,
+                        CountingTransport(fake))
+                    try:
+                        benchmark.setup()
+                        calls = benchmark.run()
+                        routes = benchmark.routes()
+                        if fake is not None:
+                            benchmark.verify()
+                    finally:
+                        benchmark.teardown()
+                    results['scenarios'].append(OrderedDict([('name', benchmark.name()),
+                        ('layers', layers), ('routers_per_layer', routers), ('prefixes', prefixes),
+                        ('routes', routes), ('calls', calls)]))
+                    for op, summary in calls.items():
+                        print('%-40s %-14s %8.2f ms  %6.1f statements  %8.1f route ops' % (
+                            benchmark.name(), op, summary['latency_median'] * 1000,
+                            summary['statements'], sum(summary['operations'].values())))
+    finally:
+        sqlite3.connect = sqlite3_connect
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results saved to %s' % args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
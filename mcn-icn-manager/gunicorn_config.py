@@ -0,0 +1,35 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+gunicorn settings for the ICN Manager, overridable from the environment.
+"""
+
+import os
+
+bind = os.environ.get('ICNAAS_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('ICNAAS_WORKERS', 2))
+# threads per worker, slow requests do not hold up the others
+worker_class = 'gthread'
+threads = int(os.environ.get('ICNAAS_THREADS', 8))
+keepalive = int(os.environ.get('ICNAAS_KEEPALIVE', 5))
+timeout = 60
+# time a worker gets on reload or shutdown to finish its requests and route job
+graceful_timeout = int(os.environ.get('ICNAAS_GRACEFUL_TIMEOUT', 120))
+# each worker imports the application itself, so its threads start after the fork
+preload_app = False
+
+def worker_exit(server, worker):
+    import webservice
+    webservice.stop_background(graceful_timeout)
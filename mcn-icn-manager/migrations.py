@@ -0,0 +1,200 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Schema migrations for the ICN Manager database.
+Version 1.0
+"""
+
+import sqlite3
+
+# Each entry upgrades the schema by one version, PRAGMA user_version
+# records the last one applied. Only append to this list.
+MIGRATIONS = [
+    # 1: initial schema, a no-op on databases created before migrations existed
+    """
+    CREATE TABLE IF NOT EXISTS "prefixes" (
+        `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        `url`   TEXT NOT NULL UNIQUE,
+        `balancing`     INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS "routers" (
+        `public_ip`     TEXT NOT NULL,
+        `hostname`      TEXT NOT NULL,
+        `coord_x`       REAL,
+        `coord_y`       REAL,
+        `layer` INTEGER NOT NULL,
+        `cell_id`       INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(public_ip)
+    );
+    CREATE TABLE IF NOT EXISTS `routes` (
+        `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        `router_ip`     TEXT NOT NULL,
+        `prefix_id`     INTEGER NOT NULL,
+        `next_hop`      TEXT NOT NULL,
+        `balancing`     NUMERIC NOT NULL DEFAULT 0,
+        FOREIGN KEY(prefix_id) REFERENCES prefixes(id)
+        FOREIGN KEY(router_ip) REFERENCES routers(public_ip)
+    );
+    """,
+    # 2: indexes for the route lookups done on every topology change
+    """
+    CREATE INDEX IF NOT EXISTS routes_router_prefix ON routes (router_ip, prefix_id);
+    CREATE INDEX IF NOT EXISTS routes_next_hop ON routes (next_hop);
+    CREATE INDEX IF NOT EXISTS routes_prefix ON routes (prefix_id);
+    CREATE INDEX IF NOT EXISTS routers_layer ON routers (layer);
+    CREATE INDEX IF NOT EXISTS routers_cell ON routers (cell_id);
+    """,
+    # 3: per table change counters, used as ETags by the listing endpoints
+    """
+    CREATE TABLE IF NOT EXISTS `table_versions` (
+        `name`  TEXT NOT NULL PRIMARY KEY,
+        `version`       INTEGER NOT NULL DEFAULT 0
+    );
+    INSERT OR IGNORE INTO table_versions (name) VALUES ('routers');
+    INSERT OR IGNORE INTO table_versions (name) VALUES ('prefixes');
+    INSERT OR IGNORE INTO table_versions (name) VALUES ('routes');
+    """ + "".join("""
+    CREATE TRIGGER IF NOT EXISTS %(table)s_version_%(event)s AFTER %(event)s ON %(table)s
+    BEGIN
+        UPDATE table_versions SET version = version + 1 WHERE name = '%(table)s';
+    END;
+    """ % { 'table': table, 'event': event }
+        for table in ('routers', 'prefixes', 'routes') for event in ('insert', 'update', 'delete')),
+    # 4: route jobs, shared by all processes serving the API
+    """
+    CREATE TABLE IF NOT EXISTS `route_jobs` (
+        `id`    INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        `state` TEXT NOT NULL,
+        `created`       REAL NOT NULL,
+        `finished`      REAL,
+        `routers`       TEXT NOT NULL,
+        `commands`      TEXT
+    );
+    CREATE INDEX IF NOT EXISTS route_jobs_state ON route_jobs (state);
+    """,
+    # 5: forwarding strategy per prefix, and the one each router was given
+    """
+    ALTER TABLE prefixes ADD COLUMN `strategy` TEXT NOT NULL DEFAULT 'default';
+    ALTER TABLE prefixes ADD COLUMN `strategy_parameters` TEXT;
+    UPDATE prefixes SET strategy = 'loadsharing' WHERE balancing > 0;
+    UPDATE routes SET balancing = 1 WHERE prefix_id IN (SELECT id FROM prefixes WHERE balancing > 0);
+    CREATE TABLE IF NOT EXISTS `router_strategies` (
+        `router_ip`     TEXT NOT NULL,
+        `prefix_id`     INTEGER NOT NULL,
+        `strategy`      TEXT NOT NULL,
+        `parameters`    TEXT,
+        PRIMARY KEY(router_ip, prefix_id),
+        FOREIGN KEY(prefix_id) REFERENCES prefixes(id) ON DELETE CASCADE
+        FOREIGN KEY(router_ip) REFERENCES routers(public_ip) ON DELETE CASCADE
+    );
+    CREATE INDEX IF NOT EXISTS router_strategies_prefix ON router_strategies (prefix_id);
+    """,
+    # 6: change events of routers, prefixes and routes, in commit order
+    """
+    CREATE TABLE IF NOT EXISTS `change_events` (
+        `seq`   INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        `created`       REAL NOT NULL,
+        `entity`        TEXT NOT NULL,
+        `action`        TEXT NOT NULL,
+        `key`   TEXT NOT NULL,
+        `old_key`       TEXT
+    );
+    """ + "".join("""
+    CREATE TRIGGER IF NOT EXISTS %(table)s_event_insert AFTER INSERT ON %(table)s
+    BEGIN
+        INSERT INTO change_events (created, entity, action, key)
+            VALUES ((julianday('now') - 2440587.5) * 86400.0, '%(entity)s', 'insert', NEW.%(key)s);
+    END;
+    CREATE TRIGGER IF NOT EXISTS %(table)s_event_update AFTER UPDATE ON %(table)s
+    BEGIN
+        INSERT INTO change_events (created, entity, action, key, old_key)
+            VALUES ((julianday('now') - 2440587.5) * 86400.0, '%(entity)s', 'update', NEW.%(key)s, OLD.%(key)s);
+    END;
+    CREATE TRIGGER IF NOT EXISTS %(table)s_event_delete AFTER DELETE ON %(table)s
+    BEGIN
+        INSERT INTO change_events (created, entity, action, key)
+            VALUES ((julianday('now') - 2440587.5) * 86400.0, '%(entity)s', 'delete', OLD.%(key)s);
+    END;
+    """ % { 'table': table, 'entity': entity, 'key': key }
+        for table, entity, key in (('routers', 'router', 'public_ip'), ('prefixes', 'prefix', 'id'),
+            ('routes', 'route', 'id'))),
+    # 7: routes of load-balancing prefixes weighted with the prefix balancing, see route_weight
+    """
+    UPDATE routes SET balancing = (SELECT MAX(prefixes.balancing, 1) FROM prefixes
+        WHERE prefixes.id = routes.prefix_id)
+        WHERE prefix_id IN (SELECT id FROM prefixes WHERE strategy IN ('loadsharing', 'parallel'));
+    """,
+    # 8: table versions are bumped once per transaction by the writers, not per row
+    "".join("""
+    DROP TRIGGER IF EXISTS %(table)s_version_%(event)s;
+    """ % { 'table': table, 'event': event }
+        for table in ('routers', 'prefixes', 'routes') for event in ('insert', 'update', 'delete')),
+    # 9: route changes become one event per router and commit, written by the API, not one per row
+    """
+    DROP TRIGGER IF EXISTS routes_event_insert;
+    DROP TRIGGER IF EXISTS routes_event_update;
+    DROP TRIGGER IF EXISTS routes_event_delete;
+    """,
+]
+
+def split_statements(script):
+    # statements end at a ';' that completes them, trigger bodies contain more
+    statements = []
+    statement = ''
+    for line in script.splitlines(True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            statements.append(statement.strip())
+            statement = ''
+    if statement.strip():
+        statements.append(statement.strip())
+    return statements
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """
+    Apply all pending migrations to conn, each in its own transaction.
+    Returns the resulting schema version.
+    """
+    conn.isolation_level = None
+    try:
+        while True:
+            # take the write lock first, so concurrent starts do not migrate twice
+            conn.execute('BEGIN IMMEDIATE')
+            version = schema_version(conn)
+            if version >= len(MIGRATIONS):
+                conn.execute('COMMIT')
+                return version
+            try:
+                for statement in split_statements(MIGRATIONS[version]):
+                    conn.execute(statement)
+                conn.execute('PRAGMA user_version = %d' % (version + 1))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = ''
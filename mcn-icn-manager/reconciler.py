@@ -0,0 +1,142 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+FIB reconciler for the ICN Manager.
+Version 1.1
+
+Periodically compares the FIB of every CCN router, as reported by
+ccndstatus, with the routes table and repairs the differences.
+"""
+
+from multiprocessing.pool import ThreadPool
+import random
+import sqlite3
+import threading
+import time
+
+from transport import normalize_uri
+
+# Seconds between reconciliation rounds, 0 disables the reconciler
+RECONCILE_INTERVAL = 300
+# Fraction of the interval added or removed at random, so managers do not align
+RECONCILE_JITTER = 0.2
+# Maximum number of routers checked concurrently
+RECONCILE_WORKERS = 8
+
+class RouteReconciler(threading.Thread):
+    """
+    read_fib(host) returns the forwarding entries of a router, like the
+    route transports of transport.py, push(host, adds, deletes) schedules
+    the repair of a router and is_idle(since) tells whether route jobs were submitted or are still
+    pending since the given job id (last_job() returns the current one).
+    Routers touched by the API while they are being checked are skipped
+    until the next round. Rounds only run while active() is true, so one
+    of several processes reconciles.
+    """
+
+    def __init__(self, database, read_fib, push, last_job, is_idle, active=None,
+            interval=RECONCILE_INTERVAL, jitter=RECONCILE_JITTER, workers=RECONCILE_WORKERS):
+        threading.Thread.__init__(self, name='route-reconciler')
+        self.daemon = True
+        self.database = database
+        self.read_fib = read_fib
+        self.push = push
+        self.last_job = last_job
+        self.is_idle = is_idle
+        self.active = active
+        self.interval = interval
+        self.jitter = jitter
+        self.workers = workers
+        self.stopped = threading.Event()
+        self.last_round = None
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        pool = ThreadPool(self.workers)
+        while not self.stopped.wait(self.delay()):
+            if self.active is not None and not self.active():
+                continue
+            try:
+                self.last_round = self.reconcile_all(pool)
+            except Exception as e:
+                print('Reconciler Exception: %s: %s' % (e.__class__, e))
+        pool.close()
+
+    def delay(self):
+        return self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def reconcile_all(self, pool):
+        conn = sqlite3.connect(self.database)
+        try:
+            routers = [row[0] for row in conn.execute('SELECT public_ip FROM routers')]
+        finally:
+            conn.close()
+        # random order, so unreachable routers do not always delay the same ones
+        random.shuffle(routers)
+        started = time.time()
+        results = pool.map(self.reconcile_router, routers)
+        out = { 'started': started, 'finished': time.time(), 'routers': len(routers), \
+            'repaired': [], 'skipped': [], 'failed': {} }
+        for router, (state, detail) in zip(routers, results):
+            if state == 'repaired':
+                out['repaired'].append(router)
+            elif state == 'skipped':
+                out['skipped'].append(router)
+            elif state == 'failed':
+                out['failed'][router] = detail
+        return out
+
+    def reconcile_router(self, host):
+        marker = self.last_job()
+        if not self.is_idle(marker):
+            return 'skipped', None
+        try:
+            actual = self.read_fib(host)
+        except Exception as e:
+            return 'failed', '%s: %s' % (e.__class__.__name__, e)
+
+        conn = sqlite3.connect(self.database)
+        try:
+            t = (host,)
+            desired = conn.execute('SELECT prefixes.url, routes.next_hop, prefixes.strategy, \
+                prefixes.strategy_parameters FROM routes \
+                JOIN prefixes ON prefixes.id = routes.prefix_id WHERE routes.router_ip = ?', t).fetchall()
+            managed = set(normalize_uri(row[0]) for row in conn.execute('SELECT url FROM prefixes'))
+        finally:
+            conn.close()
+
+        wanted = dict(((normalize_uri(row[0]), row[1]), row) for row in desired)
+        # entries for prefixes the manager does not know about are left alone
+        actual = set(entry for entry in actual if entry[0] in managed)
+        adds = [wanted[key] for key in sorted(set(wanted) - actual)]
+        deletes = sorted(actual - set(wanted))
+        if not adds and not deletes:
+            return 'in_sync', None
+        # the API changed routes meanwhile, the comparison may be stale
+        if not self.is_idle(marker):
+            return 'skipped', None
+        self.push(host, adds, deletes)
+        return 'repaired', None
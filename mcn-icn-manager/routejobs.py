@@ -0,0 +1,316 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Background route programming jobs for the ICN Manager.
+Version 1.1
+
+Jobs are stored in the route_jobs table, in the same transaction as the
+change that produced them, so every process serving the API can submit
+and report them. One process at a time, the one holding the dispatcher
+lock file, applies them.
+"""
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import fcntl
+import json
+import sqlite3
+import threading
+import time
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+ROUTER_PENDING = 'pending'
+ROUTER_DONE = 'done'
+ROUTER_FAILED = 'failed'
+
+# Maximum number of routers programmed concurrently
+JOB_WORKERS = 16
+# Attempts per router before it is reported as failed
+JOB_MAX_ATTEMPTS = 3
+# Seconds between retry rounds
+JOB_RETRY_DELAY = 5
+# Number of finished jobs kept for the status API
+JOB_HISTORY = 1000
+# Seconds between checks for jobs submitted by other processes and for
+# the dispatcher lock, when another process holds it
+JOB_POLL_INTERVAL = 1
+# Seconds a database access waits for the write lock of another process
+DATABASE_TIMEOUT = 30
+
+class RouteJob(object):
+    """
+    Set of ccndc commands, grouped by router, to be applied in the background.
+    """
+
+    def __init__(self, job_id, commands, state=JOB_QUEUED, created=None, finished=None, routers=None):
+        self.id = job_id
+        self.commands = commands
+        self.state = state
+        self.created = created if created is not None else time.time()
+        self.finished = finished
+        if routers is None:
+            routers = OrderedDict((host, { 'state': ROUTER_PENDING, 'attempts': 0, 'error': None })
+                for host in commands)
+        self.routers = routers
+
+    @classmethod
+    def from_row(cls, row):
+        # row: id, state, created, finished, routers, commands
+        commands = json.loads(row[5], object_pairs_hook=OrderedDict) if row[5] else None
+        routers = json.loads(row[4], object_pairs_hook=OrderedDict)
+        return cls(row[0], commands, row[1], row[2], row[3], routers)
+
+    def pending(self):
+        return [host for host, r in self.routers.items() if r['state'] != ROUTER_DONE]
+
+    def save(self, curs):
+        commands = json.dumps(self.commands) if self.commands is not None else None
+        data = (self.state, self.finished, json.dumps(self.routers), commands, self.id)
+        curs.execute('UPDATE route_jobs SET state = ?, finished = ?, routers = ?, commands = ? \
+            WHERE id = ?', data)
+
+    def to_dict(self):
+        done = sum(1 for r in self.routers.values() if r['state'] == ROUTER_DONE)
+        out = {
+            'id' : self.id,
+            'state' : self.state,
+            'created' : self.created,
+            'finished' : self.finished,
+            'progress' : { 'done': done, 'total': len(self.routers) },
+            'routers' : [ dict(router_ip=host, **r) for host, r in self.routers.items() ]
+        }
+        return out
+
+def create_job(curs, commands):
+    """
+    Store a job for commands (host -> list of ccndc commands) in the
+    transaction of curs, and return it as a dict. Nothing is applied
+    before that transaction commits.
+    """
+    job = RouteJob(None, commands)
+    if not commands:
+        job.state = JOB_DONE
+        job.finished = job.created
+        job.commands = None
+    data = (job.state, job.created, job.finished, json.dumps(job.routers),
+        json.dumps(job.commands) if job.commands is not None else None)
+    curs.execute('INSERT INTO route_jobs (state, created, finished, routers, commands) \
+        VALUES (?,?,?,?,?)', data)
+    job.id = curs.lastrowid
+    return job.to_dict()
+
+def get_job(curs, job_id):
+    t = (job_id,)
+    curs.execute('SELECT id, state, created, finished, routers, NULL FROM route_jobs WHERE id = ?', t)
+    row = curs.fetchone()
+    return RouteJob.from_row(row).to_dict() if row is not None else None
+
+def list_jobs(curs):
+    curs.execute('SELECT id, state, created, finished, routers, NULL FROM route_jobs ORDER BY id')
+    return [RouteJob.from_row(row).to_dict() for row in curs.fetchall()]
+
+class RouteJobDispatcher(object):
+    """
+    Applies route jobs one after the other, so the commands of a router
+    keep their order across jobs, while the routers of one job are
+    programmed in parallel. push(host, commands) returns None on success
+    and a description of the failure otherwise.
+    """
+
+    def __init__(self, database, push, workers=JOB_WORKERS, max_attempts=JOB_MAX_ATTEMPTS,
+            retry_delay=JOB_RETRY_DELAY, history=JOB_HISTORY, poll_interval=JOB_POLL_INTERVAL):
+        self.database = database
+        self.push = push
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.history = history
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.lock_file = None
+        self.pool = None
+        self.thread = None
+
+    def connect(self):
+        return sqlite3.connect(self.database, timeout=DATABASE_TIMEOUT)
+
+    def submit(self, commands):
+        # for changes that are not part of an API transaction
+        conn = self.connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            job = create_job(conn.cursor(), commands)
+            conn.commit()
+        finally:
+            conn.close()
+        self.wake()
+        return job
+
+    def wake(self):
+        self.start()
+        self.wakeup.set()
+
+    def last_job(self):
+        conn = self.connect()
+        try:
+            return conn.execute('SELECT IFNULL(MAX(id), 0) FROM route_jobs').fetchone()[0]
+        finally:
+            conn.close()
+
+    def is_idle(self, since):
+        """
+        True if no job was submitted after job id since and none is pending.
+        """
+        conn = self.connect()
+        try:
+            last, active = conn.execute('SELECT IFNULL(MAX(id), 0), \
+                SUM(state IN (?, ?)) FROM route_jobs', (JOB_QUEUED, JOB_RUNNING)).fetchone()
+        finally:
+            conn.close()
+        return last == since and not active
+
+    def is_leader(self):
+        # True while this process holds the dispatcher lock
+        return self.lock_file is not None
+
+    def start(self):
+        # Threads are created on first use, not at import time
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.pool = ThreadPool(self.workers)
+                self.thread = threading.Thread(target=self.run, name='route-jobs')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Finish the job being applied and stop; queued jobs stay in the
+        database for the next dispatcher. Returns False if the job was still
+        running after timeout seconds.
+        """
+        with self.lock:
+            thread = self.thread
+        if thread is None:
+            return True
+        self.stopping.set()
+        self.wakeup.set()
+        thread.join(timeout)
+        if thread.is_alive():
+            return False
+        with self.lock:
+            self.thread = None
+            self.pool.close()
+            self.pool = None
+        return True
+
+    def run(self):
+        conn = self.connect()
+        try:
+            while not self.stopping.is_set():
+                if not self.is_leader() and self.acquire():
+                    self.recover(conn)
+                if self.is_leader():
+                    try:
+                        if self.process_next(conn):
+                            continue
+                    except Exception as e:
+                        print('Route Job Exception: %s: %s' % (e.__class__, e))
+                        conn.rollback()
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+        finally:
+            conn.close()
+            self.release()
+
+    def acquire(self):
+        lock_file = open(self.database + '.jobs.lock', 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def recover(self, conn):
+        # jobs left running by a dispatcher that died are applied again
+        t = (JOB_QUEUED, JOB_RUNNING)
+        conn.execute('UPDATE route_jobs SET state = ? WHERE state = ?', t)
+        conn.commit()
+
+    def process_next(self, conn):
+        t = (JOB_QUEUED,)
+        row = conn.execute('SELECT id, state, created, finished, routers, commands FROM route_jobs \
+            WHERE state = ? ORDER BY id LIMIT 1', t).fetchone()
+        conn.commit()
+        if row is None:
+            return False
+        self.process(conn, RouteJob.from_row(row))
+        self.expire(conn)
+        return True
+
+    def process(self, conn, job):
+        job.state = JOB_RUNNING
+        self.save(conn, job)
+        for attempt in range(self.max_attempts):
+            hosts = job.pending()
+            if not hosts:
+                break
+            if attempt > 0:
+                time.sleep(self.retry_delay)
+            pending = [(host, self.pool.apply_async(self.push, (host, job.commands[host])))
+                for host in hosts]
+            for host, res in pending:
+                error = res.get()
+                router = job.routers[host]
+                router['attempts'] += 1
+                router['error'] = error
+                router['state'] = ROUTER_DONE if error is None else ROUTER_FAILED
+            self.save(conn, job)
+        job.state = JOB_FAILED if job.pending() else JOB_DONE
+        job.finished = time.time()
+        job.commands = None
+        self.save(conn, job)
+
+    def save(self, conn, job):
+        job.save(conn.cursor())
+        conn.commit()
+
+    def expire(self, conn):
+        t = (JOB_DONE, JOB_FAILED, self.history)
+        conn.execute('DELETE FROM route_jobs WHERE state IN (?, ?) AND id <= \
+            (SELECT id FROM route_jobs ORDER BY id DESC LIMIT 1 OFFSET ?)', t)
+        conn.commit()
@@ -0,0 +1,115 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Router lookup cache for the ICN Manager.
+Version 1.0
+"""
+
+import threading
+import time
+
+# Seconds a cached lookup is served before the routers table version is
+# checked again, bounds staleness when another process writes the table
+ROUTER_CACHE_TTL = 2
+
+def cell_key(cell_id):
+    # '7' from a URL and 7 from a row are the same cell
+    try:
+        return int(cell_id)
+    except (TypeError, ValueError):
+        return cell_id
+
+class RouterCache(object):
+    """
+    Read-through cache of cell_id -> routers and public_ip -> router.
+    current_version() returns the routers table version and is only called
+    when the entries are older than ttl. Writes in this process are applied
+    with invalidate(), like EdgeRouterIndex.apply.
+    """
+
+    def __init__(self, current_version, ttl=ROUTER_CACHE_TTL):
+        self.current_version = current_version
+        self.ttl = ttl
+        self.cells = {}
+        self.routers = {}
+        self.version = None
+        self.checked = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_cell(self, cell_id, load):
+        return self.get(self.cells, cell_key(cell_id), load)
+
+    def get_router(self, public_ip, load):
+        return self.get(self.routers, public_ip, load)
+
+    def get(self, entries, key, load):
+        with self.lock:
+            if time.time() - self.checked < self.ttl and key in entries:
+                self.hits += 1
+                return entries[key]
+        version = self.current_version()
+        with self.lock:
+            if version != self.version:
+                self.clear()
+                self.version = version
+            self.checked = time.time()
+            if key in entries:
+                self.hits += 1
+                return entries[key]
+            self.misses += 1
+        value = load(key)
+        with self.lock:
+            if self.version == version:
+                entries[key] = value
+        return value
+
+    def invalidate(self, version, changes):
+        """
+        Drop the entries touched by (old router or None, new router or None)
+        changes that brought the routers table to version, or all entries if
+        the cache did not reflect the version right before them.
+        """
+        with self.lock:
+            if self.version is None or self.version + len(changes) != version:
+                self.clear()
+                self.version = None
+                return
+            for change in changes:
+                for router in change:
+                    if router is not None:
+                        self.routers.pop(router[0], None)
+                        self.cells.pop(cell_key(router[5]), None)
+            self.version = version
+
+    def clear(self):
+        # in place, get() holds on to the dicts
+        self.cells.clear()
+        self.routers.clear()
+
+    def stats(self):
+        with self.lock:
+            return { 'hits': self.hits, 'misses': self.misses,
+                'cells': len(self.cells), 'routers': len(self.routers), 'version': self.version }
@@ -0,0 +1,281 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Spatial index of the edge routers for the ICN Manager.
+Version 1.0
+"""
+
+import heapq
+import math
+import threading
+
+# Side of a grid cell, in the unit of coord_x and coord_y, until there are
+# two distinct points to derive it from
+GRID_CELL_SIZE = 1.0
+# Points per occupied cell the cell size is derived for
+GRID_CELL_POINTS = 2.0
+# How many times the points may outnumber that, or grow or shrink in number
+# or spread since the grid was fitted, before it is fitted again
+GRID_REFIT_FACTOR = 4.0
+GRID_MAX_HALVINGS = 16
+EDGE_LAYER = 0
+
+def finite(value):
+    # a coordinate the grid can place: a number, not NaN or infinite
+    try:
+        return not math.isinf(float(value)) and not math.isnan(float(value))
+    except (TypeError, ValueError):
+        return False
+
+def grid_cell_size(points):
+    """
+    Cell side for about GRID_CELL_POINTS of the (x, y) points per occupied
+    cell: the side that spreads them evenly over their bounding box, halved
+    while clusters crowd the cells. GRID_CELL_SIZE when they share one spot.
+    """
+    points = list(points)
+    if not points:
+        return GRID_CELL_SIZE
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+    width = max(xs) - min(xs)
+    height = max(ys) - min(ys)
+    # points on a line are spread over its length
+    size = max(math.sqrt(width * height * GRID_CELL_POINTS / len(points)),
+        max(width, height) * GRID_CELL_POINTS / len(points))
+    if not size > 0:
+        return GRID_CELL_SIZE
+    for i in range(GRID_MAX_HALVINGS):
+        cells = set((math.floor(x / size), math.floor(y / size)) for x, y in points)
+        if len(points) <= GRID_REFIT_FACTOR * GRID_CELL_POINTS * len(cells):
+            break
+        size /= 2
+    return size
+
+class GridIndex(object):
+    """
+    Uniform grid of points, answering k nearest neighbour queries by
+    searching rings of cells around the query point, clipped to the
+    occupied cells.
+    """
+
+    def __init__(self, cell_size=GRID_CELL_SIZE):
+        self.cell_size = float(cell_size)
+        # key -> (x, y)
+        self.points = {}
+        # (column, row) -> set of keys
+        self.cells = {}
+        # (min column, min row, max column, max row) of the occupied cells,
+        # not shrunk when points are removed
+        self.bounds = None
+        # (points, area) when fitted to its points, see fit
+        self.fitted = None
+
+    @classmethod
+    def fit(cls, points):
+        # grid of points, key -> (x, y), with a cell size derived from them
+        grid = cls(grid_cell_size(points.values()))
+        for key, (x, y) in points.items():
+            grid.insert(key, x, y)
+        grid.fitted = (len(grid.points), grid.area())
+        return grid
+
+    def cell(self, x, y):
+        return (int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size)))
+
+    def insert(self, key, x, y):
+        self.remove(key)
+        self.points[key] = (x, y)
+        column, row = self.cell(x, y)
+        self.cells.setdefault((column, row), set()).add(key)
+        if self.bounds is None:
+            self.bounds = (column, row, column, row)
+        else:
+            min_column, min_row, max_column, max_row = self.bounds
+            self.bounds = (min(min_column, column), min(min_row, row),
+                max(max_column, column), max(max_row, row))
+
+    def remove(self, key):
+        point = self.points.pop(key, None)
+        if point is None:
+            return
+        cell = self.cell(*point)
+        self.cells[cell].discard(key)
+        if not self.cells[cell]:
+            del self.cells[cell]
+        if not self.points:
+            self.bounds = None
+
+    def area(self):
+        # cells within the bounds
+        if self.bounds is None:
+            return 0
+        min_column, min_row, max_column, max_row = self.bounds
+        return (max_column - min_column + 1) * (max_row - min_row + 1)
+
+    def balanced(self):
+        """
+        False once the points grew or shrank GRID_REFIT_FACTOR times in
+        number or spread since the grid was fitted to them.
+        """
+        if self.fitted is None:
+            return True
+        points, area = self.fitted
+        return points / GRID_REFIT_FACTOR <= len(self.points) <= max(points, 1) * GRID_REFIT_FACTOR \
+            and self.area() <= max(area, 1) * GRID_REFIT_FACTOR
+
+    def nearest(self, x, y, k):
+        """
+        Return up to k (distance, key) pairs, closest first.
+        """
+        if k <= 0 or not self.points:
+            return []
+        column, row = self.cell(x, y)
+        min_column, min_row, max_column, max_row = self.bounds
+        # rings that do not reach the occupied cells are empty
+        ring = max(min_column - column, column - max_column, min_row - row, row - max_row, 0)
+        found = []
+        searched = 0
+        while True:
+            cells = self.ring_cells(column, row, ring)
+            searched += len(cells)
+            # scanning every occupied cell is cheaper than searching this many
+            if searched >= len(self.cells):
+                found = [self.distance(x, y, key) for key in self.points]
+                break
+            for cell in cells:
+                found.extend(self.distance(x, y, key) for key in self.cells.get(cell, ()))
+            closest = self.unsearched_distance(x, y, column, row, ring)
+            if closest is None or len(found) >= k and heapq.nsmallest(k, found)[-1][0] <= closest:
+                break
+            ring += 1
+        return heapq.nsmallest(k, found)
+
+    def distance(self, x, y, key):
+        px, py = self.points[key]
+        return (math.hypot(px - x, py - y), key)
+
+    def ring_cells(self, column, row, ring):
+        # cells of the ring within the bounds
+        min_column, min_row, max_column, max_row = self.bounds
+        if ring == 0:
+            return [(column, row)] if min_column <= column <= max_column \
+                and min_row <= row <= max_row else []
+        cells = []
+        columns = range(max(column - ring, min_column), min(column + ring, max_column) + 1)
+        for r in (row - ring, row + ring):
+            if min_row <= r <= max_row:
+                cells.extend((c, r) for c in columns)
+        rows = range(max(row - ring + 1, min_row), min(row + ring - 1, max_row) + 1)
+        for c in (column - ring, column + ring):
+            if min_column <= c <= max_column:
+                cells.extend((c, r) for r in rows)
+        return cells
+
+    def unsearched_distance(self, x, y, column, row, ring):
+        """
+        Distance from (x, y) to the closest cell within the bounds but outside
+        the ring, None once there is none.
+        """
+        min_column, min_row, max_column, max_row = self.bounds
+        # the bounds left, right, below and above the ring
+        parts = ((min_column, min_row, column - ring - 1, max_row),
+            (column + ring + 1, min_row, max_column, max_row),
+            (min_column, min_row, max_column, row - ring - 1),
+            (min_column, row + ring + 1, max_column, max_row))
+        distances = []
+        for first_column, first_row, last_column, last_row in parts:
+            if first_column > last_column or first_row > last_row:
+                continue
+            dx = max(first_column * self.cell_size - x, 0, x - (last_column + 1) * self.cell_size)
+            dy = max(first_row * self.cell_size - y, 0, y - (last_row + 1) * self.cell_size)
+            distances.append(math.hypot(dx, dy))
+        return min(distances) if distances else None
+
+class EdgeRouterIndex(object):
+    """
+    Grid of the edge routers that have coordinates, kept in step with the
+    routers table. version is the routers table version the index reflects
+    (None when it must be reloaded); every router row written bumps it by one.
+    Without a cell_size the cell size follows the routers: the grid is
+    fitted to them on load and again once changes leave it unbalanced.
+    """
+
+    def __init__(self, cell_size=None):
+        self.cell_size = cell_size
+        self.grid = self.build({})
+        # public_ip -> router tuple
+        self.routers = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def build(self, points):
+        if self.cell_size is None:
+            return GridIndex.fit(points)
+        grid = GridIndex(self.cell_size)
+        for key, (x, y) in points.items():
+            grid.insert(key, x, y)
+        return grid
+
+    def load(self, routers, version):
+        points = {}
+        indexed = {}
+        for router in routers:
+            if self.indexable(router):
+                points[router[0]] = (float(router[2]), float(router[3]))
+                indexed[router[0]] = tuple(router)
+        grid = self.build(points)
+        with self.lock:
+            self.grid = grid
+            self.routers = indexed
+            self.version = version
+    def apply(self, version, changes):
+        """
+        Apply (old public_ip or None, new router or None) changes that
+        brought the routers table to version. If the index did not reflect
+        the version right before them it is left for a reload instead.
+        """
+        with self.lock:
+            if self.version is None or self.version + len(changes) != version:
+                self.version = None
+                return False
+            for old_ip, router in changes:
+                if old_ip is not None:
+                    self.grid.remove(old_ip)
+                    self.routers.pop(old_ip, None)
+                if router is not None and self.indexable(router):
+                    self.grid.insert(router[0], float(router[2]), float(router[3]))
+                    self.routers[router[0]] = tuple(router)
+            if self.cell_size is None and not self.grid.balanced():
+                self.grid = self.build(self.grid.points)
+            self.version = version
+            return True
+
+    def nearest(self, x, y, k):
+        # (distance, router tuple) pairs, closest first
+        with self.lock:
+            return [(distance, self.routers[key]) for distance, key in self.grid.nearest(x, y, k)]
+
+    def indexable(self, router):
+        return finite(router[2]) and finite(router[3]) and int(router[4]) == EDGE_LAYER
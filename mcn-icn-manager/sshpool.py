@@ -0,0 +1,152 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+SSH connection pool for the ICN Manager.
+Version 1.0
+"""
+
+import socket
+import threading
+import time
+
+import paramiko
+
+SSH_USERNAME = 'centos'
+SSH_KEY_FILENAME = 'id_rsa'
+SSH_CONNECT_TIMEOUT = 5
+# Seconds a remote command may run before it is abandoned
+SSH_COMMAND_TIMEOUT = 30
+# Seconds a connection may stay unused before it is closed
+SSH_IDLE_TIMEOUT = 300
+# Seconds between keepalive packets on open connections
+SSH_KEEPALIVE_INTERVAL = 30
+
+class SSHConnectionPool(object):
+    """
+    Keeps one authenticated SSH connection per router, so that several
+    commands to the same router share a single key exchange.
+    """
+
+    def __init__(self, username=SSH_USERNAME, key_filename=SSH_KEY_FILENAME,
+            timeout=SSH_CONNECT_TIMEOUT, command_timeout=SSH_COMMAND_TIMEOUT,
+            idle_timeout=SSH_IDLE_TIMEOUT, keepalive=SSH_KEEPALIVE_INTERVAL):
+        self.username = username
+        self.key_filename = key_filename
+        self.timeout = timeout
+        self.command_timeout = command_timeout
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        # host -> { 'client': SSHClient, 'last_used': timestamp, 'lock': Lock }
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def execute(self, host, command):
+        """
+        Run command on host and return its exit status. A broken connection
+        is reopened once before the error is raised to the caller.
+        """
+        return self.run(host, command)[0]
+
+    def run(self, host, command):
+        """
+        Like execute, but returns (exit status, standard output).
+        """
+        self.evict_idle()
+        for attempt in range(2):
+            client = self.get(host)
+            try:
+                stdin, stdout, stderr = client.exec_command(command, timeout=self.command_timeout)
+                # the channel timeout bounds every read, so a stuck command raises socket.timeout
+                output = stdout.read()
+                if not stdout.channel.status_event.wait(self.command_timeout):
+                    stdout.channel.close()
+                    raise socket.timeout('Command timed out after %s seconds' % self.command_timeout)
+                status = stdout.channel.recv_exit_status()
+                self.touch(host)
+                return status, output
+            except socket.timeout:
+                raise
+            except (paramiko.SSHException, socket.error, EOFError):
+                self.discard(host)
+                if attempt > 0:
+                    raise
+
+    def get(self, host):
+        """
+        Return a connected client for host, opening a new one if none is
+        open or the existing one is no longer active.
+        """
+        with self.lock:
+            entry = self.connections.get(host)
+            if entry is None:
+                entry = { 'client': None, 'last_used': time.time(), 'lock': threading.Lock() }
+                self.connections[host] = entry
+        # Connect outside the pool lock, so a slow router does not block the others
+        with entry['lock']:
+            client = entry['client']
+            if client is None or not self.is_active(client):
+                if client is not None:
+                    client.close()
+                client = self.connect(host)
+                entry['client'] = client
+            entry['last_used'] = time.time()
+            return client
+
+    def connect(self, host):
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, username=self.username, key_filename=self.key_filename,
+            timeout=self.timeout)
+        client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def is_active(self, client):
+        transport = client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def touch(self, host):
+        with self.lock:
+            entry = self.connections.get(host)
+            if entry is not None:
+                entry['last_used'] = time.time()
+
+    def discard(self, host):
+        with self.lock:
+            entry = self.connections.pop(host, None)
+        if entry is not None and entry['client'] is not None:
+            entry['client'].close()
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            idle = [host for host, entry in self.connections.items()
+                if now - entry['last_used'] > self.idle_timeout]
+        for host in idle:
+            self.discard(host)
+
+    def close_all(self):
+        with self.lock:
+            hosts = list(self.connections.keys())
+        for host in hosts:
+            self.discard(host)
@@ -0,0 +1,103 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Tests of the spatial index of the edge routers.
+Version 1.0
+
+    python -m unittest test_spatial
+"""
+
+import math
+import random
+import unittest
+
+import spatial
+
+def edge_router(i, x, y):
+    return ('10.0.%d.%d' % (i // 256, i % 256), 'edge%d' % i, x, y, spatial.EDGE_LAYER, 1)
+
+class EdgeRouterIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.random = random.Random(1)
+        self.routers = [edge_router(i, self.random.uniform(0, 100), self.random.uniform(0, 100))
+            for i in range(1000)]
+        self.index = spatial.EdgeRouterIndex()
+        self.index.load(self.routers, 1)
+
+    def assertNearest(self, x, y, k=3):
+        expected = sorted((math.hypot(router[2] - x, router[3] - y), router) for router in self.routers)
+        self.assertEqual(self.index.nearest(x, y, k), expected[:k])
+
+    def test_cell_size_follows_routers(self):
+        self.assertTrue(1 < self.index.grid.cell_size < 10)
+        self.routers = [edge_router(i, router[2] / 1000.0, router[3] / 1000.0)
+            for i, router in enumerate(self.routers)]
+        self.index.load(self.routers, 2)
+        self.assertTrue(self.index.grid.cell_size < 0.01)
+        self.assertNearest(0.05, 0.05)
+
+    def test_nearest_inside(self):
+        for i in range(20):
+            self.assertNearest(self.random.uniform(0, 100), self.random.uniform(0, 100))
+
+    def test_nearest_outside(self):
+        # far away queries search from the routers closest to them, not all of them
+        grid = self.index.grid
+        measured = []
+        def distance(x, y, key):
+            measured.append(key)
+            return spatial.GridIndex.distance(grid, x, y, key)
+        grid.distance = distance
+        for x, y in ((-500, 50), (50, 1e6), (-1e4, -1e4), (1e9, -1e9)):
+            del measured[:]
+            self.assertNearest(x, y)
+            self.assertTrue(len(measured) < len(self.routers) / 10, (x, y, len(measured)))
+
+    def test_cluster(self):
+        self.routers = [edge_router(i, self.random.gauss(50, 0.1), self.random.gauss(50, 0.1))
+            for i in range(500)] + self.routers[:20]
+        self.index.load(self.routers, 2)
+        self.assertNearest(50, 50)
+        self.assertNearest(0, 0)
+
+    def test_refit_on_changes(self):
+        cell_size = self.index.grid.cell_size
+        spread = [edge_router(1000 + i, self.random.uniform(0, 1e4), self.random.uniform(0, 1e4))
+            for i in range(2000)]
+        self.assertTrue(self.index.apply(2001, [(None, router) for router in spread]))
+        self.routers += spread
+        self.assertTrue(self.index.grid.cell_size > 10 * cell_size)
+        self.assertNearest(5000, 5000)
+        self.assertTrue(self.index.apply(4991, [(router[0], None) for router in self.routers[:2990]]))
+        self.routers = self.routers[2990:]
+        self.assertNearest(50, 50)
+        self.assertEqual(len(self.index.nearest(50, 50, 20)), 10)
+
+    def test_stale_version(self):
+        self.assertFalse(self.index.apply(3, [(None, edge_router(2000, 1, 1))]))
+        self.assertEqual(self.index.version, None)
+
+if __name__ == '__main__':
+    unittest.main()
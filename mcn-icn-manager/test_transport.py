@@ -0,0 +1,163 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Tests of the fake routers and of the route engine running on them.
+Version 1.0
+
+    python -m unittest test_transport
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import benchmark
+import migrations
+import reconciler
+import transport
+
+ADD = 'add ccnx:/a tcp 10.0.0.2 9695'
+
+class CcndcCheckTest(unittest.TestCase):
+
+    def rejects(self, line):
+        self.assertRaises(transport.TransportError, transport.ccndc_check, line)
+
+    def test_valid_lines(self):
+        self.assertEqual(transport.ccndc_check(ADD), ADD.split())
+        self.assertEqual(transport.ccndc_check('del ccnx:/a\ttcp 10.0.0.2 9695 3 0'),
+            ['del', 'ccnx:/a', 'tcp', '10.0.0.2', '9695', '3', '0'])
+        self.assertEqual(transport.ccndc_check('add /a face 7'), ['add', '/a', 'face', '7'])
+        self.assertEqual(transport.ccndc_check('setstrategy ccnx:/a loadsharing'),
+            ['setstrategy', 'ccnx:/a', 'loadsharing'])
+
+    def test_skipped_lines(self):
+        self.assertEqual(transport.ccndc_check(''), [])
+        self.assertEqual(transport.ccndc_check('# ' + ADD), [])
+        self.assertEqual(transport.ccndc_check('setstrategy ccnx:/a'), [])
+        self.assertEqual(transport.ccndc_check('removestrategy a'), [])
+
+    def test_rejected_lines(self):
+        self.rejects('add ccnx:/a b tcp 10.0.0.2 9695')
+        self.rejects('add ccnx:/a#b tcp 10.0.0.2 9695')
+        self.rejects('add a tcp 10.0.0.2 9695')
+        self.rejects('add ccnx:/a sctp 10.0.0.2 9695')
+        self.rejects('add ccnx:/a tcp')
+        self.rejects('add ccnx:/a tcp 10.0.0.2 96950')
+        self.rejects('add ccnx:/a tcp 10.0.0.2 9695 256')
+        self.rejects('add ccnx:/a udp 224.0.23.170 9695 3 300')
+        self.rejects('add ccnx:/a face 0')
+        self.rejects('add ccnx:/' + 'a' * transport.CCNDC_LINE_MAX + ' tcp 10.0.0.2')
+        self.rejects('removestrategy')
+        self.rejects('route ccnx:/a')
+
+class FakeTransportTest(unittest.TestCase):
+
+    def test_push(self):
+        fake = transport.FakeTransport()
+        self.assertEqual(fake.push('10.0.0.1', [ADD, 'setstrategy ccnx:/a parallel']), None)
+        self.assertEqual(fake.read_fib('10.0.0.1'), set([('ccnx:/a', '10.0.0.2')]))
+        self.assertEqual(fake.router('10.0.0.1').strategies, { 'ccnx:/a': ('parallel', None) })
+        fake.push('10.0.0.1', ['del ccnx:/a/ tcp 10.0.0.2 9695', 'removestrategy ccnx:/a'])
+        self.assertEqual(fake.read_fib('10.0.0.1'), set())
+        self.assertEqual(fake.router('10.0.0.1').strategies, {})
+
+    def test_malformed_line_drops_batch(self):
+        fake = transport.FakeTransport()
+        fake.push('10.0.0.1', [ADD])
+        error = fake.push('10.0.0.1', ['del ccnx:/a tcp 10.0.0.2 9695',
+            'add ccnx:/b tcp 10.0.0.3 9695', 'add ccnx:/c d tcp 10.0.0.3 9695'])
+        self.assertTrue(error.startswith('TransportError'))
+        self.assertEqual(fake.read_fib('10.0.0.1'), set([('ccnx:/a', '10.0.0.2')]))
+
+    def test_down(self):
+        fake = transport.FakeTransport(down=['10.0.0.1'])
+        self.assertTrue(fake.push('10.0.0.1', [ADD]).startswith('TransportError'))
+        self.assertRaises(transport.TransportError, fake.read_fib, '10.0.0.1')
+
+class ReconcilerTest(unittest.TestCase):
+    """
+    FIBs are compared in the ccnx:/ form ccndstatus reports names in,
+    whatever form the prefix url was stored in.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='icnaas-test')
+        database = os.path.join(self.directory, 'routers.db')
+        conn = sqlite3.connect(database)
+        try:
+            migrations.migrate(conn)
+            conn.executemany('INSERT INTO routers (public_ip, hostname, layer) VALUES (?,?,?)',
+                [('10.0.0.1', 'edge', 0), ('10.0.0.2', 'core', 1)])
+            conn.execute("INSERT INTO prefixes (id, url) VALUES (1, '/foo/')")
+            conn.execute("INSERT INTO routes (router_ip, prefix_id, next_hop) VALUES ('10.0.0.1', 1, '10.0.0.2')")
+            conn.commit()
+        finally:
+            conn.close()
+        self.fake = transport.FakeTransport()
+        self.pushed = []
+        self.reconciler = reconciler.RouteReconciler(database, self.fake.read_fib,
+            lambda host, adds, deletes: self.pushed.append((host, adds, deletes)),
+            lambda: 0, lambda since: True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_in_sync(self):
+        self.fake.push('10.0.0.1', ['add ccnx:/foo tcp 10.0.0.2 9695'])
+        self.assertEqual(self.fake.read_fib('10.0.0.1'), set([('ccnx:/foo', '10.0.0.2')]))
+        self.assertEqual(self.reconciler.reconcile_router('10.0.0.1'), ('in_sync', None))
+        self.assertEqual(self.pushed, [])
+
+    def test_repaired(self):
+        self.fake.push('10.0.0.1', ['add /foo tcp 10.0.0.3 9695', 'add ccnx:/other tcp 10.0.0.3 9695'])
+        self.assertEqual(self.reconciler.reconcile_router('10.0.0.1'), ('repaired', None))
+        host, adds, deletes = self.pushed[0]
+        self.assertEqual([add[:2] for add in adds], [('/foo/', '10.0.0.2')])
+        self.assertEqual(deletes, [('ccnx:/foo', '10.0.0.3')])
+
+class RouteEngineTest(unittest.TestCase):
+    """
+    Router and prefix changes through the API, applied to fake routers,
+    leave every FIB equal to the routes table.
+    """
+
+    def test_routes_applied(self):
+        fake = transport.FakeTransport()
+        run = benchmark.Benchmark(2, 4, 6, 2, benchmark.CountingTransport(fake))
+        try:
+            run.setup()
+            run.run()
+            run.verify()
+            self.assertTrue(run.routes() > 0)
+            router = next(router for host, router in sorted(fake.routers.items()) if router.fib)
+            router.fib.pop(sorted(router.fib)[0])
+            self.assertRaises(RuntimeError, run.verify)
+        finally:
+            run.teardown()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Layered topology model of the ICN Manager.
+Version 1.0
+
+Routers are organised in layers (0 = edge, 100 = content sources). Every
+router forwards every prefix to all routers of the next populated layer
+above its own; routers of the highest layer have no routes.
+"""
+
+from collections import OrderedDict
+
+class Topology(object):
+    """
+    In-memory view of the routers and prefixes tables, used to compute the
+    FIB each router should have.
+    """
+
+    def __init__(self):
+        # public_ip -> router tuple as stored in the routers table
+        self.routers = {}
+        # layer -> set of public_ips
+        self.layers = {}
+        # cell_id -> set of public_ips
+        self.cells = {}
+        # prefix id -> (url, balancing, strategy, strategy_parameters)
+        self.prefixes = OrderedDict()
+
+    @classmethod
+    def load(cls, curs):
+        topology = cls()
+        curs.execute('SELECT * FROM routers')
+        for router in curs.fetchall():
+            topology.add_router(router)
+        curs.execute('SELECT * FROM prefixes ORDER BY id')
+        for prefix in curs.fetchall():
+            topology.add_prefix(prefix)
+        return topology
+
+    def copy(self):
+        topology = Topology()
+        for router in self.routers.values():
+            topology.add_router(router)
+        for prefix_id, prefix in self.prefixes.items():
+            topology.add_prefix((prefix_id,) + prefix)
+        return topology
+
+    def add_router(self, router):
+        # router: (public_ip, hostname, coord_x, coord_y, layer, cell_id)
+        public_ip = router[0]
+        if public_ip in self.routers:
+            self.remove_router(public_ip)
+        self.routers[public_ip] = tuple(router)
+        self.layers.setdefault(int(router[4]), set()).add(public_ip)
+        self.cells.setdefault(router[5], set()).add(public_ip)
+
+    def remove_router(self, public_ip):
+        router = self.routers.pop(public_ip, None)
+        if router is None:
+            return None
+        for index, key in ((self.layers, int(router[4])), (self.cells, router[5])):
+            index[key].discard(public_ip)
+            if not index[key]:
+                del index[key]
+        return router
+
+    def add_prefix(self, prefix):
+        # prefix: a row of the prefixes table
+        self.prefixes[int(prefix[0])] = tuple(prefix[1:])
+
+    def remove_prefix(self, prefix_id):
+        return self.prefixes.pop(int(prefix_id), None)
+
+    def layer_of(self, public_ip):
+        return int(self.routers[public_ip][4])
+
+    def next_layer(self, layer):
+        higher = [l for l in self.layers if l > int(layer)]
+        return min(higher) if higher else None
+
+    def previous_layer(self, layer):
+        lower = [l for l in self.layers if l < int(layer)]
+        return max(lower) if lower else None
+
+    def layer_routers(self, layer):
+        if layer is None:
+            return set()
+        return set(self.layers.get(int(layer), ()))
+
+    def affected_routers(self, public_ip, layer):
+        """
+        Routers whose FIB may change when public_ip joins or leaves layer:
+        the router itself and the routers of the layer below.
+        """
+        affected = self.layer_routers(self.previous_layer(layer))
+        affected.add(public_ip)
+        return affected
+
+    def next_hops(self, public_ip):
+        # routers public_ip forwards every prefix to
+        if public_ip not in self.routers:
+            return set()
+        return self.layer_routers(self.next_layer(self.layer_of(public_ip)))
+
+    def edge_changes(self, planned, router_ips):
+        """
+        Next hops router_ips gain and lose from this topology to planned, as
+        (router_ip, added, removed) sorted by router, unchanged routers left out.
+        """
+        changes = []
+        for router_ip in sorted(router_ips):
+            before = self.next_hops(router_ip)
+            after = planned.next_hops(router_ip)
+            if before != after:
+                changes.append((router_ip, after - before, before - after))
+        return changes
+
+    def desired_routes(self, public_ip, prefix_ids=None):
+        """
+        Set of (prefix_id, next_hop) the router should have.
+        """
+        if public_ip not in self.routers:
+            return set()
+        next_hops = self.next_hops(public_ip)
+        if prefix_ids is None:
+            prefix_ids = self.prefixes.keys()
+        return set((prefix_id, next_hop) for prefix_id in prefix_ids
+            if prefix_id in self.prefixes for next_hop in next_hops)
+
+    def diff_routes(self, current, router_ips=None, prefix_ids=None):
+        """
+        Compare current routes with the desired ones for router_ips (all
+        routers if None), restricted to prefix_ids if given.
+
+        current holds (id, router_ip, prefix_id, next_hop, ...) rows of those
+        routers. Returns (adds, deletes): adds as (router_ip, prefix_id,
+        next_hop), deletes as the current rows that are no longer wanted.
+        """
+        if prefix_ids is not None:
+            prefix_ids = set(int(p) for p in prefix_ids)
+        existing = {}
+        for route in current:
+            if prefix_ids is not None and int(route[2]) not in prefix_ids:
+                continue
+            existing.setdefault(route[1], {})[(int(route[2]), route[3])] = route
+        if router_ips is None:
+            router_ips = set(self.routers) | set(existing)
+        adds = []
+        deletes = []
+        for router_ip in sorted(router_ips):
+            have = existing.get(router_ip, {})
+            want = self.desired_routes(router_ip, prefix_ids)
+            for key in sorted(set(have) - want):
+                deletes.append(have[key])
+            for prefix_id, next_hop in sorted(want - set(have)):
+                adds.append((router_ip, prefix_id, next_hop))
+        return adds, deletes
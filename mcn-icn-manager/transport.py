@@ -0,0 +1,320 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Route transports for the ICN Manager.
+Version 1.0
+
+A transport applies ccndc commands to a CCN router and reads its FIB back:
+
+    push(host, commands) returns None on success, otherwise a description
+    of the failure.
+    read_fib(host) returns the set of (prefix uri, next hop ip) forwarding
+    entries pointing to other CCN routers, and raises on failure.
+"""
+
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+CCNDC_PATH = '/home/centos/ccnx-0.8.2/bin/ccndc'
+CCNDSTATUS_PATH = '/home/centos/ccnx-0.8.2/bin/ccndstatus'
+CCN_PORT = 9695
+# ccndc -f reads lines into a buffer of 1024 bytes, longer ones are split
+CCNDC_LINE_MAX = 1023
+# Printed by ccndc -f when its check pass rejects a line, nothing is applied then
+# and ccndc still exits with status 0
+CCNDC_CHECK_ERROR = 'Error: near line'
+# Exit status of ccndc_script when ccndc rejected the batch
+CCNDC_REJECTED = 65
+# Forwarding flags ccndc accepts in add and del
+CCN_FORW_PUBMASK = 0xff
+# Names ccn_name_from_uri accepts: absolute, with an optional ccnx: scheme
+CCN_URI = re.compile(r'((ccnx|ccn):)?/', re.IGNORECASE)
+
+class TransportError(Exception):
+    pass
+
+def normalize_uri(uri):
+    # names the way ccndstatus prints them: ccnx: scheme, no trailing '/'
+    match = CCN_URI.match(uri)
+    if match is None:
+        return uri.rstrip('/') or uri
+    return 'ccnx:/' + uri[match.end():].rstrip('/')
+
+def valid_uri(uri):
+    # ccndc splits lines on whitespace and cuts them at '#', such a uri breaks the whole batch
+    return bool(CCN_URI.match(uri)) and not re.search(r'[\s#]', uri) and len(uri) < CCNDC_LINE_MAX // 2
+
+def ccndc_check(line):
+    """
+    The check pass of ccndc -f for one line. Returns its words, none for
+    blank and comment lines and for strategy commands ccndc skips, and
+    raises TransportError where ccndc would reject the whole file. Faces
+    are only checked for form, not resolved: hosts must be addresses or
+    host names and ports numbers.
+    """
+    if len(line) > CCNDC_LINE_MAX:
+        raise TransportError('line longer than %d characters' % CCNDC_LINE_MAX)
+    words = [word for word in re.split('[ \t]', line.split('#', 1)[0]) if word]
+    if not words:
+        return []
+    op = words[0].lower()
+    if op in ('add', 'del'):
+        uri, proto, host, port, flags, ttl = (words[1:7] + [None] * 6)[:6]
+        if uri is None or not CCN_URI.match(uri):
+            raise TransportError('bad CCNx URI: %s' % line)
+        if proto is None or proto.lower() not in ('udp', 'tcp', 'face'):
+            raise TransportError('bad address type: %s' % line)
+        if proto.lower() == 'face':
+            if host is None or not host.isdigit() or not 0 < int(host) < 2 ** 32:
+                raise TransportError('bad face number: %s' % line)
+            return words
+        if host is None or not re.match(r'[0-9A-Za-z.:-]+$', host) \
+                or port is not None and not (port.isdigit() and 0 < int(port) < 65536):
+            raise TransportError('bad host or port: %s' % line)
+        if flags is not None and not (flags.isdigit() and int(flags) & ~CCN_FORW_PUBMASK == 0):
+            raise TransportError('bad flags: %s' % line)
+        if ttl is not None and not (ttl.isdigit() and int(ttl) <= 255):
+            raise TransportError('bad multicast ttl: %s' % line)
+        return words
+    if op in ('setstrategy', 'getstrategy', 'removestrategy'):
+        if len(words) < 2:
+            raise TransportError('missing prefix: %s' % line)
+        # a strategy command that does not parse is skipped, not rejected
+        if not CCN_URI.match(words[1]) or op == 'setstrategy' and len(words) < 3:
+            return []
+        return words
+    raise TransportError('bad command: %s' % line)
+
+def parse_fib(status_xml):
+    """
+    Return the set of (prefix uri, next hop ip) forwarding entries that
+    point to another CCN router, from the output of ccndstatus -x.
+    """
+    root = ElementTree.fromstring(status_xml)
+    faces = {}
+    for face in root.iter('face'):
+        address = face.findtext('ip')
+        if address is None or ':' not in address:
+            continue
+        host, port = address.rsplit(':', 1)
+        if int(port) == CCN_PORT:
+            faces[face.findtext('faceid')] = host
+    fib = set()
+    for fentry in root.iter('fentry'):
+        prefix = normalize_uri(fentry.findtext('prefix'))
+        for dest in fentry.iter('dest'):
+            host = faces.get(dest.findtext('faceid'))
+            if host is not None:
+                fib.add((prefix, host))
+    return fib
+
+def ccndc_script(commands, ccndc_path=CCNDC_PATH):
+    # ccndc reads the configuration file twice (check, then apply), so it
+    # has to be written to a temporary file instead of piped in; a rejected
+    # batch is only reported on stderr, the script turns it into an exit status
+    return 'f=$(mktemp) && e=$(mktemp) && cat > $f <<\'CCNDC_EOF\'\n' \
+        + '\n'.join(commands) + '\nCCNDC_EOF\n' \
+        + ccndc_path + ' -f $f 2>$e; rc=$?; cat $e >&2; ' \
+        + 'grep -q \'' + CCNDC_CHECK_ERROR + '\' $e && rc=' + str(CCNDC_REJECTED) + '; ' \
+        + 'rm -f $f $e; exit $rc'
+
+class SSHTransport(object):
+    """
+    Runs ccndc and ccndstatus on the routers over the connections of an
+    sshpool.SSHConnectionPool.
+    """
+
+    def __init__(self, pool, ccndc_path=CCNDC_PATH, ccndstatus_path=CCNDSTATUS_PATH):
+        self.pool = pool
+        self.ccndc_path = ccndc_path
+        self.ccndstatus_path = ccndstatus_path
+
+    def push(self, host, commands):
+        try:
+            status = self.pool.execute(host, ccndc_script(commands, self.ccndc_path))
+        except Exception as e:
+            print('SSH Connection Exception: %s: %s' % (e.__class__, e))
+            return '%s: %s' % (e.__class__.__name__, e)
+        if status == CCNDC_REJECTED:
+            print('SSH Command Failed: %s: ccndc rejected the batch' % host)
+            return 'ccndc rejected the batch'
+        if status != 0:
+            print('SSH Command Failed: %s: exit status %d' % (host, status))
+            return 'exit status %d' % status
+
+    def read_fib(self, host):
+        status, output = self.pool.run(host, self.ccndstatus_path + ' -x')
+        if status != 0:
+            raise TransportError('ccndstatus exit status %d' % status)
+        return parse_fib(output)
+
+class LocalTransport(object):
+    """
+    Runs ccndc and ccndstatus on this machine, for a manager sharing its
+    host with the router. ports maps hosts to the CCN_LOCAL_PORT of their
+    ccnd, so several ccnd instances on one machine can stand in for a
+    topology; hosts not in ports use the default ccnd.
+    """
+
+    def __init__(self, ports=None, ccndc_path=CCNDC_PATH, ccndstatus_path=CCNDSTATUS_PATH):
+        self.ports = ports or {}
+        self.ccndc_path = ccndc_path
+        self.ccndstatus_path = ccndstatus_path
+
+    def environment(self, host):
+        env = dict(os.environ)
+        if host in self.ports:
+            env['CCN_LOCAL_PORT'] = str(self.ports[host])
+        return env
+
+    def push(self, host, commands):
+        handle, path = tempfile.mkstemp(prefix='ccndc')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write('\n'.join(commands) + '\n')
+            process = subprocess.Popen([self.ccndc_path, '-f', path], stderr=subprocess.PIPE,
+                env=self.environment(host))
+            errors = process.communicate()[1]
+            status = process.returncode
+        except OSError as e:
+            print('Local Command Exception: %s: %s' % (e.__class__, e))
+            return '%s: %s' % (e.__class__.__name__, e)
+        finally:
+            os.remove(path)
+        if CCNDC_CHECK_ERROR in errors:
+            print('Local Command Failed: %s: ccndc rejected the batch: %s' % (host, errors.strip()))
+            return 'ccndc rejected the batch'
+        if status != 0:
+            print('Local Command Failed: %s: exit status %d' % (host, status))
+            return 'exit status %d' % status
+
+    def read_fib(self, host):
+        process = subprocess.Popen([self.ccndstatus_path, '-x'], stdout=subprocess.PIPE,
+            env=self.environment(host))
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise TransportError('ccndstatus exit status %d' % process.returncode)
+        return parse_fib(output)
+
+class FakeRouter(object):
+    """
+    FIB and strategy table of a simulated ccnd, changed by ccndc commands.
+    """
+
+    def __init__(self):
+        # prefix uri -> set of next hops
+        self.fib = {}
+        # prefix uri -> (strategy, parameters)
+        self.strategies = {}
+        self.commands = []
+
+    def parse(self, command):
+        # (operation, prefix, argument words) or None, after the check pass of ccndc -f
+        words = ccndc_check(command)
+        if not words:
+            return None
+        op = words[0].lower()
+        if op in ('add', 'del'):
+            return op, normalize_uri(words[1]), words[2:4]
+        if op == 'setstrategy':
+            return op, normalize_uri(words[1]), words[2:4]
+        return op, normalize_uri(words[1]), []
+
+    def apply(self, commands):
+        """
+        Apply ccndc commands the way ccndc -f does: nothing is applied if
+        one of them fails the check pass.
+        """
+        parsed = [self.parse(command) for command in commands]
+        for op, prefix, args in filter(None, parsed):
+            if op in ('add', 'del') and args[0].lower() == 'face':
+                # only faces to other routers are kept, as in parse_fib
+                continue
+            if op == 'add':
+                self.fib.setdefault(prefix, set()).add(args[1])
+            elif op == 'del':
+                hops = self.fib.get(prefix, set())
+                hops.discard(args[1])
+                if not hops:
+                    self.fib.pop(prefix, None)
+            elif op == 'setstrategy':
+                self.strategies[prefix] = (args[0], ' '.join(args[1:]) or None)
+            elif op == 'removestrategy':
+                self.strategies.pop(prefix, None)
+        self.commands.extend(commands)
+
+    def entries(self):
+        return set((prefix, hop) for prefix, hops in self.fib.items() for hop in hops)
+
+class FakeTransport(object):
+    """
+    In-process routers, created on first use, for running the route engine
+    against thousands of simulated routers. Hosts in down fail like an
+    unreachable router, delay adds seconds of simulated latency per push.
+    Counters: pushes, commands.
+    """
+
+    def __init__(self, delay=0, down=None):
+        self.delay = delay
+        self.down = set(down or ())
+        self.routers = {}
+        self.pushes = 0
+        self.commands = 0
+        self.lock = threading.Lock()
+
+    def router(self, host):
+        with self.lock:
+            return self.routers.setdefault(host, FakeRouter())
+
+    def push(self, host, commands):
+        if self.delay:
+            time.sleep(self.delay)
+        if host in self.down:
+            return 'TransportError: %s is down' % host
+        router = self.router(host)
+        with self.lock:
+            self.pushes += 1
+            self.commands += len(commands)
+            try:
+                router.apply(commands)
+            except TransportError as e:
+                return 'TransportError: %s' % e
+
+    def read_fib(self, host):
+        if host in self.down:
+            raise TransportError('%s is down' % host)
+        router = self.router(host)
+        with self.lock:
+            return router.entries()
+
+    def reset(self):
+        with self.lock:
+            self.routers = {}
+            self.pushes = 0
+            self.commands = 0
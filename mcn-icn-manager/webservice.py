@@ -27,11 +27,117 @@ Version 1.4
 """
 
 #!flask/bin/python
-from flask import Flask, jsonify, abort, make_response, request, url_for
+from flask import Flask, jsonify, abort, make_response, request, url_for, g, \
+    Response, stream_with_context
+from collections import OrderedDict
+import atexit
+import hashlib
+import itertools
+import json
+import os
 import sqlite3
-import paramiko
+import threading
+import time
+
+import migrations
+import reconciler
+import routercache
+import routejobs
+import spatial
+import sshpool
+import transport
+from topology import Topology
+
+DATABASE = 'routers.db'
+# Maximum page size of the listing endpoints
+LIST_MAX_LIMIT = 1000
+# Rows per chunk written by the streaming listings
+STREAM_CHUNK_ROWS = 100
+NDJSON_MIMETYPE = 'application/x-ndjson'
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+# Change events kept for consumers resuming from a sequence number
+CHANGE_EVENT_HISTORY = 100000
+# Events per response, or per write of an event stream
+EVENT_BATCH = 1000
+# Maximum seconds a long poll waits for events
+EVENT_MAX_WAIT = 30
+# Seconds between checks for events committed by other processes
+EVENT_POLL_INTERVAL = 0.5
+# Seconds between keepalive comments of an idle event stream, and before it
+# is closed so the client reconnects with Last-Event-ID
+EVENT_KEEPALIVE = 15
+EVENT_STREAM_DURATION = 60
+# Requests per process that may hold a worker thread waiting for events, half
+# of the gunicorn threads; the others are answered with what is there at once
+EVENT_MAX_WAITERS = max(1, int(os.environ.get('ICNAAS_THREADS', 8)) // 2)
+# Seconds a stream answered at once asks the client to wait before reconnecting
+EVENT_BUSY_RETRY = 5
+# How ccndc commands reach the routers: ssh, local or fake (see transport.py)
+ROUTE_TRANSPORT = os.environ.get('ICNAAS_TRANSPORT', 'ssh')
+# Forwarding strategies built into ccnd 0.8.2 (csrc/ccnd/*_strategy.c)
+CCND_STRATEGIES = ('default', 'loadsharing', 'parallel', 'faceattr', 'null', 'trace')
+# Strategies spreading interests over the next hops, whose routes get weight 1
+BALANCING_STRATEGIES = ('loadsharing', 'parallel')
+# Estimated cost of pushing a command batch to a router, for dry runs:
+# SSH round trip and ccndc start, plus each command
+PUSH_SECONDS_PER_ROUTER = 0.5
+PUSH_SECONDS_PER_COMMAND = 0.02
 
 app = Flask(__name__)
+# notified when this process commits a change, other processes are polled
+change_condition = threading.Condition()
+ssh_pool = sshpool.SSHConnectionPool()
+atexit.register(ssh_pool.close_all)
+
+def make_transport(name):
+    if name == 'ssh':
+        return transport.SSHTransport(ssh_pool)
+    if name == 'local':
+        return transport.LocalTransport()
+    if name == 'fake':
+        return transport.FakeTransport()
+    raise ValueError('Unknown route transport: %s' % name)
+
+route_transport = make_transport(ROUTE_TRANSPORT)
+router_locks = {}
+router_locks_lock = threading.Lock()
+edge_index = spatial.EdgeRouterIndex()
+
+def get_db():
+    # one connection and one transaction per request, committed by the endpoint
+    conn = getattr(g, 'db', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, timeout=routejobs.DATABASE_TIMEOUT)
+        conn.execute('PRAGMA foreign_keys = ON')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        # DDL commits the open transaction, so it cannot wait until a bulk statement
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS prefix_batch (id INTEGER PRIMARY KEY)')
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS router_batch (public_ip TEXT PRIMARY KEY)')
+        if request.method in ('POST', 'PUT', 'DELETE') and not is_dry_run():
+            # writers queue here, before reading the state their change is based on
+            conn.execute('BEGIN IMMEDIATE')
+        elif request.method in ('POST', 'PUT', 'DELETE'):
+            # a dry run only reads, from one snapshot, without the write lock
+            conn.execute('BEGIN')
+        g.db = conn
+    return conn
+
+def init_db():
+    # bring an existing routers.db up to the current schema
+    conn = sqlite3.connect(DATABASE)
+    try:
+        version = migrations.migrate(conn)
+    finally:
+        conn.close()
+    print('Database %s at schema version %d' % (DATABASE, version))
+
+@app.teardown_appcontext
+def close_db(error):
+    # anything not committed by the endpoint is rolled back
+    conn = getattr(g, 'db', None)
+    if conn is not None:
+        conn.close()
 
 @app.route('/availability', methods=['GET'])
 def availability():
@@ -39,104 +145,122 @@ def availability():
 
 @app.route('/icnaas/api/v1.0/routers', methods=['GET'])
 def get_routers():
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('SELECT * FROM routers')
-    res = curs.fetchall()
-    conn.close()
-    routers = [
-    {
-        'public_ip' : public_ip, 
-        'hostname' : hostname,
-        'coord_x' : coord_x,
-        'coord_y' : coord_y,
-        'layer' : layer,
-        'cell_id' : cell_id
-    } for public_ip, hostname, coord_x, coord_y, layer, cell_id in res
-    ]
-    #return jsonify({'routers': [router_to_dict(router) for router in routers]})
-    return jsonify({'routers': [make_public_router(router) for router in routers]}), 200
+    etag = collection_etag(curs, 'routers')
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    where, args = collection_filters({ 'layer': 'layer', 'cell_id': 'cell_id' })
+    res, next_cursor = fetch_page(curs, 'SELECT * FROM routers', 'public_ip', where, args)
+    routers = (make_public_router(router_to_dict(router)) for router in res)
+    return collection_response('routers', routers, next_cursor, etag)
 
 @app.route('/icnaas/api/v1.0/routers/cell/<cell_id>', methods=['GET'])
 def get_routers_cell(cell_id):
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-    t = (cell_id,)
-    curs.execute('SELECT * FROM routers WHERE cell_id = ?', t)
-    res = curs.fetchall()
-    conn.close()
-    routers = [
-    {
-        'public_ip' : public_ip, 
-        'hostname' : hostname,
-        'coord_x' : coord_x,
-        'coord_y' : coord_y,
-        'layer' : layer,
-        'cell_id' : cell_id
-    } for public_ip, hostname, coord_x, coord_y, layer, cell_id in res
-    ]
-    #return jsonify({'routers': [router_to_dict(router) for router in routers]})
-    return jsonify({'routers': [make_public_router(router) for router in routers]}), 200
+    res = router_cache.get_cell(cell_id, load_cell_routers)
+    routers = [make_public_router(router_to_dict(router)) for router in res]
+    return jsonify({'routers': routers}), 200
 
 @app.route('/icnaas/api/v1.0/routers/<router_id>', methods=['GET'])
 def get_router(router_id):
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-    t = (router_id,)
-    curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
-    router = curs.fetchone()
-    conn.close()
+    router = router_cache.get_router(router_id, load_router)
     if router is None:
         abort(404)
     return jsonify({'router': router_to_dict(router)}), 200
 
+@app.route('/icnaas/api/v1.0/cache', methods=['GET'])
+def get_cache():
+    return jsonify({'cache': router_cache.stats()}), 200
+
+def load_cell_routers(cell_id):
+    t = (cell_id,)
+    curs = get_db().cursor()
+    curs.execute('SELECT * FROM routers WHERE cell_id = ?', t)
+    return curs.fetchall()
+
+def load_router(public_ip):
+    t = (public_ip,)
+    curs = get_db().cursor()
+    curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
+    return curs.fetchone()
+
 @app.route('/icnaas/api/v1.0/routers', methods=['POST'])
 def create_router():
-    if not request.json or not 'public_ip' in request.json \
-        or not 'hostname' in request.json \
-        or not 'layer' in request.json \
-        or not 'cell_id' in request.json :
+    if not request.json:
         abort(400)
+    router = router_from_json(request.json)
 
-    if 'coord_x' in request.json and 'coord_y' in request.json:
-        router = (request.json['public_ip'], request.json['hostname'],
-                request.json['coord_x'], request.json['coord_y'],
-                request.json['layer'], request.json['cell_id']);
-    else:
-        router = (request.json['public_ip'], request.json['hostname'],
-                None, None, request.json['layer'], request.json['cell_id']);
-
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
     t = (request.json['public_ip'],)
     curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
     rt = curs.fetchone()
     if rt is not None:
         abort(409)
+    topology = Topology.load(curs)
+    planned = topology.copy()
+    planned.add_router(router)
+    affected = planned.affected_routers(router[0], router[4])
+    if is_dry_run():
+        return job_accepted({'router': router_to_dict(router)},
+            dry_run_router_routes(curs, topology, planned, affected))
     curs.execute('INSERT INTO routers VALUES (?,?,?,?,?,?)', router)
-    conn.commit()
 
-    # add routes to this new router (if not content source), 
+    # add routes to this new router (if not content source),
     # add routes to other routers (previous layer if exists)
-    layer = int(request.json['layer'])
-    if layer != 100:
-        create_routes_router(request.json['public_ip'], layer)
-    if layer > 0:
-        t = (layer,)
-        curs.execute('SELECT MAX(layer) AS layer FROM routers WHERE layer < ?;', t)
-        item = curs.fetchone()
-        if item is not None:
-            create_routes_layer_single(item[0], request.json['public_ip'], layer)
-    conn.close()
-
-    return jsonify({'router': router_to_dict(router)}), 201
+    sync_router_routes(topology, planned, affected)
+    job = commit_routers(conn, [(None, router)])
+
+    return job_accepted({'router': router_to_dict(router)}, job)
+
+@app.route('/icnaas/api/v1.0/routers/bulk', methods=['POST'])
+def create_routers():
+    if not request.json or type(request.json.get('routers')) is not list \
+        or not request.json['routers']:
+        abort(400)
+    routers = [router_from_json(data) for data in request.json['routers']]
+    public_ips = [router[0] for router in routers]
+    if len(set(public_ips)) != len(public_ips):
+        abort(400)
+
+    conn = get_db()
+    curs = conn.cursor()
+    topology = Topology.load(curs)
+    if any(public_ip in topology.routers for public_ip in public_ips):
+        abort(409)
+    planned = topology.copy()
+    for router in routers:
+        planned.add_router(router)
+    affected = set()
+    for router in routers:
+        affected |= planned.affected_routers(router[0], router[4])
+    if is_dry_run():
+        return job_accepted({'routers': [router_to_dict(router) for router in routers]},
+            dry_run_router_routes(curs, topology, planned, affected))
+    curs.executemany('INSERT INTO routers VALUES (?,?,?,?,?,?)', routers)
+
+    # one route computation for the whole batch, one command batch per router
+    sync_router_routes(topology, planned, affected)
+    job = commit_routers(conn, [(None, router) for router in routers])
+
+    return job_accepted({'routers': [router_to_dict(router) for router in routers]}, job)
+
+def router_from_json(data):
+    if type(data) is not dict or not 'public_ip' in data \
+        or not 'hostname' in data \
+        or not 'layer' in data \
+        or not 'cell_id' in data :
+        abort(400)
+
+    if 'coord_x' in data and 'coord_y' in data:
+        return (data['public_ip'], data['hostname'], data['coord_x'], data['coord_y'],
+                data['layer'], data['cell_id'])
+    return (data['public_ip'], data['hostname'], None, None, data['layer'], data['cell_id'])
 
 @app.route('/icnaas/api/v1.0/routers/<router_id>', methods=['PUT'])
 def update_router(router_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
     t = (router_id,)
     curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
     router = curs.fetchone()
@@ -153,64 +277,49 @@ def update_router(router_id):
     if 'cell_id' not in request.json:
         abort(400)
 
-    conn.commit()
-    conn.close()
-
-    # update all routes with this router (first delete)
-    delete_routes_dst(router_id)
-
-    # delete all routers from this router
-    delete_routes_router(router_id)
-
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
-
-    # check if more routers exist at the layer, and otherwise add routes to reroute
-    p = (router[4], router_id)
-    curs.execute('SELECT * FROM routers WHERE layer = ? and public_ip NOT LIKE ?', p)
-    layer_router = curs.fetchone()
-    if layer_router is None:
-        q = (router[4],)
-        curs.execute('SELECT MAX(layer) AS layer FROM routers WHERE layer < ?;', q)
-        prev = curs.fetchone()
-        curs.execute('SELECT MIN(layer) AS layer FROM routers WHERE layer > ?;', q)
-        next = curs.fetchone()
-        if prev is not None and next is not None:
-            create_routes_layer_multiple(prev[0], next[0])
-
     if 'coord_x' in request.json and 'coord_y' in request.json:
-        data = (request.json['public_ip'], request.json['hostname'],
-                request.json['coord_x'], request.json['coord_y'],  
-                request.json['layer'], request.json['cell_id'], router_id);
-        curs.execute('UPDATE routers SET public_ip = ?, hostname = ?, coord_x = ?, coord_y = ?, layer = ?, cell_id = ? \
-                    WHERE public_ip = ?', data)
-    else:    
-        data = (request.json['public_ip'], request.json['hostname'], 
-                request.json['layer'], request.json['cell_id'], router_id);
-        curs.execute('UPDATE routers SET public_ip = ?, hostname = ?, layer = ?, cell_id = ? \
-                    WHERE public_ip = ?', data)
-    conn.commit()
+        new_router = (request.json['public_ip'], request.json['hostname'],
+                request.json['coord_x'], request.json['coord_y'],
+                request.json['layer'], request.json['cell_id'])
+    else:
+        new_router = (request.json['public_ip'], request.json['hostname'],
+                router[2], router[3], request.json['layer'], request.json['cell_id'])
+
+    # routers below the old and the new position, before and after the change
+    topology = Topology.load(curs)
+    planned = topology.copy()
+    planned.remove_router(router_id)
+    planned.add_router(new_router)
+    affected = set()
+    for model in (topology, planned):
+        affected |= model.affected_routers(router_id, router[4]) \
+            | model.affected_routers(new_router[0], new_router[4])
+    if is_dry_run():
+        # routes and strategies of a new address are planned from scratch, as when applied
+        return job_accepted({'router': router_to_dict(new_router)},
+            dry_run_router_routes(curs, topology, planned, affected))
+    adds, deletes = plan_router_routes(curs, topology, planned, affected)
+
+    # routes from the old address go first, they reference the router row
+    remove_routes(curs, deletes)
+    if new_router[0] != router_id:
+        # another address may be another ccnd, which has no strategies yet
+        curs.execute('DELETE FROM router_strategies WHERE router_ip = ?', t)
+    data = new_router + (router_id,)
+    curs.execute('UPDATE routers SET public_ip = ?, hostname = ?, coord_x = ?, coord_y = ?, layer = ?, cell_id = ? \
+                WHERE public_ip = ?', data)
+    add_routes(curs, planned, adds)
+
     t = (request.json['public_ip'],)
     curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
     router_new = curs.fetchone()
+    job = commit_routers(conn, [(router, router_new)])
 
-    # update all routes with this router (then create)
-    layer = int(request.json['layer'])
-    if layer != 100:
-        create_routes_router(request.json['public_ip'], layer)
-    if layer > 0:
-        curs.execute('SELECT MAX(layer) AS layer FROM routers WHERE layer < ?;', p)
-        item = curs.fetchone()
-        if item is not None:
-            create_routes_layer_single(item[0], request.json['public_ip'], layer)
-    conn.close()
-
-    return jsonify({'router': router_to_dict(router_new)}), 200
+    return job_accepted({'router': router_to_dict(router_new)}, job)
 
 @app.route('/icnaas/api/v1.0/routers/<router_id>', methods=['DELETE'])
 def delete_router(router_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
     t = (router_id,)
     curs.execute('SELECT * FROM routers WHERE public_ip = ?', t)
@@ -218,36 +327,20 @@ def delete_router(router_id):
     if router is None:
         abort(404)
 
-    # check if more routers exist at the layer, and otherwise add routes to reroute
-    p = (router[4], router_id)
-    curs.execute('SELECT * FROM routers WHERE layer = ? and public_ip NOT LIKE ?', p)
-    layer_router = curs.fetchone()
-    if layer_router is None:
-        q = (router[4],)
-        curs.execute('SELECT MAX(layer) AS layer FROM routers WHERE layer < ?;', q)
-        prev = curs.fetchone()
-        curs.execute('SELECT MIN(layer) AS layer FROM routers WHERE layer > ?;', q)
-        next = curs.fetchone()
-        if prev is not None and next is not None:
-            create_routes_layer_multiple(prev[0], next[0])
-
-    # delete all routes to this router, add new routes to higher layer if needed
-    curs.execute('SELECT * FROM routes WHERE next_hop = ?', t)
-    if curs.fetchone() is not None:
-        conn.commit()
-        conn.close()
-        delete_routes_dst(router_id)
-
-    # delete all routers from this router
-    delete_routes_router(router_id)
+    # delete all routes from and to this router, reroute the layer below if it was the last one
+    topology = Topology.load(curs)
+    planned = topology.copy()
+    planned.remove_router(router_id)
+    affected = topology.affected_routers(router_id, router[4])
+    if is_dry_run():
+        return job_accepted({'result': True}, dry_run_router_routes(curs, topology, planned, affected))
+    sync_router_routes(topology, planned, affected)
 
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
+    curs.execute('DELETE FROM router_strategies WHERE router_ip = ?', t)
     curs.execute('DELETE FROM routers WHERE public_ip = ?', t)
-    conn.commit()
-    conn.close()
+    job = commit_routers(conn, [(router, None)])
 
-    return jsonify({'result': True}), 200
+    return job_accepted({'result': True}, job)
 
 @app.errorhandler(404)
 def not_found(error):
@@ -257,7 +350,7 @@ def make_public_router(router):
     new_router= {}
     for field in router:
         if field == 'public_ip':
-            new_router['uri'] = url_for('get_router', router_id=router['public_ip'], _external=True)
+            new_router['uri'] = resource_uri('get_router', router['public_ip'])
             new_router['public_ip'] = router[field]
         else:
             new_router[field] = router[field]
@@ -276,67 +369,128 @@ def router_to_dict(router):
 
 @app.route('/icnaas/api/v1.0/prefixes', methods=['GET'])
 def get_prefixes():
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('SELECT * FROM prefixes')
-    res = curs.fetchall()
-    conn.close()
-    prefixes = [
-    {
-        'id' : prefix_id,
-        'url' : url,
-        'balancing' : balancing
-    } for prefix_id, url, balancing in res
-    ]
-    #return jsonify({'prefixes': [prefix_to_dict(prefix) for prefix in prefixes]})
-    return jsonify({'prefixes': [make_public_prefix(prefix) for prefix in prefixes]}), 200
+    etag = collection_etag(curs, 'prefixes')
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    where, args = collection_filters({ 'url': 'url' })
+    res, next_cursor = fetch_page(curs, 'SELECT * FROM prefixes', 'id', where, args)
+    prefixes = (make_public_prefix(prefix_to_dict(prefix)) for prefix in res)
+    return collection_response('prefixes', prefixes, next_cursor, etag)
 
 @app.route('/icnaas/api/v1.0/prefixes/<prefix_id>', methods=['GET'])
 def get_prefix(prefix_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
     t = (prefix_id,)
     curs.execute('SELECT * FROM prefixes WHERE id = ?', t)
     prefix = curs.fetchone()
-    conn.close()
     if prefix is None:
         abort(404)
     return jsonify({'prefix': prefix_to_dict(prefix)}), 200
 
 @app.route('/icnaas/api/v1.0/prefixes', methods=['POST'])
 def create_prefix():
-    if not request.json or not 'url' in request.json \
-        or not 'balancing' in request.json :
+    # either one prefix or { 'prefixes': [...] } to import a batch
+    if not request.json:
         abort(400)
+    bulk = 'prefixes' in request.json
+    if bulk:
+        if type(request.json['prefixes']) is not list or not request.json['prefixes']:
+            abort(400)
+        data = [prefix_from_json(prefix) for prefix in request.json['prefixes']]
+    else:
+        data = [prefix_from_json(request.json)]
 
-    data = (request.json['url'], request.json['balancing']);
-
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
-    t = (request.json['url'],)
-    curs.execute('SELECT * FROM prefixes WHERE url = ?', t)
-    prefix = curs.fetchone()
-    if prefix is not None:
-        abort(409)
-    curs.execute('INSERT INTO prefixes (url, balancing) VALUES (?,?)', data)
-    conn.commit()
-    rowid = curs.lastrowid
-    t = (rowid,)
-    curs.execute('SELECT * FROM prefixes WHERE id = ?', t)
-    prefix = curs.fetchone()
-    conn.close()
+    if is_dry_run():
+        prefixes, plan = dry_run_import_prefixes(curs, data)
+        if bulk:
+            return job_accepted({'prefixes': [prefix_to_dict(prefix) for prefix in prefixes]}, plan)
+        return job_accepted({'prefix': prefix_to_dict(prefixes[0])}, plan)
+    prefixes = import_prefixes(curs, data)
+    job = commit_route_changes(conn)
+
+    if bulk:
+        return job_accepted({'prefixes': [prefix_to_dict(prefix) for prefix in prefixes]}, job)
+    return job_accepted({'prefix': prefix_to_dict(prefixes[0])}, job)
+
+@app.route('/icnaas/api/v1.0/prefixes', methods=['DELETE'])
+def delete_prefixes():
+    if not request.json or type(request.json.get('prefixes')) is not list \
+        or not request.json['prefixes']:
+        abort(400)
+    try:
+        prefix_ids = set(int(prefix_id) for prefix_id in request.json['prefixes'])
+    except (TypeError, ValueError):
+        abort(400)
 
-    # add new routes to all routers
-    create_routes_prefix(rowid, request.json['url'], request.json['balancing'])
+    conn = get_db()
+    curs = conn.cursor()
+    if is_dry_run():
+        return job_accepted({'result': True}, dry_run_remove_prefixes(curs, prefix_ids))
+    if remove_prefixes(curs, prefix_ids) != len(prefix_ids):
+        abort(404)
+    job = commit_route_changes(conn)
+
+    return job_accepted({'result': True}, job)
+
+def prefix_from_json(data, old_prefix=None):
+    """
+    Return (url, balancing, strategy, strategy_parameters) from a request,
+    the url in the ccnx:/ form the routers report it in.
+    Without a strategy, balancing > 0 selects loadsharing as it always did,
+    and an update that keeps balancing, or gives none, keeps the strategy.
+    """
+    if type(data) is not dict or not 'url' in data \
+        or (not 'balancing' in data and not 'strategy' in data):
+        abort(400)
+    if not isinstance(data['url'], basestring) or not transport.valid_uri(data['url']):
+        abort(400)
+    balancing = None
+    if data.get('balancing') is not None:
+        balancing = balancing_from_json(data['balancing'])
+    strategy = data.get('strategy')
+    parameters = data.get('strategy_parameters')
+    if strategy is None:
+        if old_prefix is not None and (balancing in (None, old_prefix[2]) \
+                or balancing > 0 and old_prefix[3] in BALANCING_STRATEGIES):
+            strategy, parameters = old_prefix[3], old_prefix[4]
+        elif balancing is not None and balancing > 0:
+            strategy = 'loadsharing'
+        else:
+            strategy = 'default'
+    if not isinstance(strategy, basestring) or strategy not in CCND_STRATEGIES:
+        abort(400)
+    # parameters end up in a ccndc command line
+    if parameters is not None and (type(parameters) is not unicode or not parameters \
+            or len(parameters.split()) != 1):
+        abort(400)
+    if balancing is None:
+        if old_prefix is not None and strategy == old_prefix[3]:
+            balancing = old_prefix[2]
+        else:
+            balancing = 1 if strategy in BALANCING_STRATEGIES else 0
+    return (transport.normalize_uri(data['url']), balancing, strategy, parameters)
 
-    return jsonify({'prefix': prefix_to_dict(prefix)}), 201
+def balancing_from_json(value):
+    # a weight: a non-negative integer, or a string of one
+    if type(value) is bool or isinstance(value, float) and not value.is_integer():
+        abort(400)
+    try:
+        balancing = int(value)
+    except (TypeError, ValueError):
+        abort(400)
+    if balancing < 0:
+        abort(400)
+    return balancing
 
 @app.route('/icnaas/api/v1.0/prefixes/<prefix_id>', methods=['PUT'])
 def update_prefix(prefix_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
     t = (prefix_id,)
     curs.execute('SELECT * FROM prefixes WHERE id=?', t)
     prefix = curs.fetchone()
@@ -346,54 +500,47 @@ def update_prefix(prefix_id):
         abort(400)
     if 'url' in request.json and type(request.json['url']) != unicode:
         abort(400)
-    if 'balancing' not in request.json:
-        abort(400)
 
-    data = (request.json['url'], request.json['balancing'], prefix_id);
-    curs.execute('UPDATE prefixes SET url = ?, balancing = ? \
+    old_prefix = prefix
+    data = prefix_from_json(request.json, old_prefix) + (prefix_id,)
+    if is_dry_run():
+        prefix = (prefix[0],) + data[:4]
+        return job_accepted({'prefix': prefix_to_dict(prefix)}, dry_run_update_prefix(curs, old_prefix, prefix))
+    curs.execute('UPDATE prefixes SET url = ?, balancing = ?, strategy = ?, strategy_parameters = ? \
                 WHERE id = ?', data)
-    conn.commit()
+    get_route_changes().touched('prefixes')
     curs.execute('SELECT * FROM prefixes WHERE id = ?', t)
     prefix = curs.fetchone()
-    conn.close()
 
-    # change routes in all routers
-    delete_routes_prefix(prefix_id, prefix[1])
-    create_routes_prefix(prefix_id, request.json['url'])
+    # change routes in all routers, the routes table itself is unchanged
+    refresh_prefix_routes(curs, old_prefix, prefix)
+    job = commit_route_changes(conn)
 
-    return jsonify({'prefix': prefix_to_dict(prefix)}), 200
+    return job_accepted({'prefix': prefix_to_dict(prefix)}, job)
 
 @app.route('/icnaas/api/v1.0/prefixes/<prefix_id>', methods=['DELETE'])
 def delete_prefix(prefix_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
     t = (prefix_id,)
     curs.execute('SELECT * FROM prefixes WHERE id = ?', t)
     prefix = curs.fetchone()
     if prefix is None:
         abort(404)
 
-    conn.commit()
-    conn.close()
-
+    if is_dry_run():
+        return job_accepted({'result': True}, dry_run_remove_prefixes(curs, [prefix[0]]))
     # delete routes in all routers
-    delete_routes_prefix(prefix_id, prefix[1])
-
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-    curs.execute('PRAGMA foreign_keys = ON')
-    curs.execute('DELETE FROM prefixes WHERE id = ?', t)
-    conn.commit()
-    conn.close()
+    remove_prefixes(curs, [prefix[0]])
+    job = commit_route_changes(conn)
 
-    return jsonify({'result': True}), 200
+    return job_accepted({'result': True}, job)
 
 def make_public_prefix(prefix):
     new_prefix= {}
     for field in prefix:
         if field == 'id':
-            new_prefix['uri'] = url_for('get_prefix', prefix_id=prefix['id'], _external=True)
+            new_prefix['uri'] = resource_uri('get_prefix', prefix['id'])
         else:
             new_prefix[field] = prefix[field]
     return new_prefix
@@ -402,37 +549,35 @@ def prefix_to_dict(prefix):
     out = {
         'id' : prefix[0], 
         'url' : prefix[1],
-        'balancing' : prefix[2]
+        'balancing' : prefix[2],
+        'strategy' : prefix[3],
+        'strategy_parameters' : prefix[4]
     }
     return out
 
 @app.route('/icnaas/api/v1.0/routes', methods=['GET'])
 def get_routes():
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
-    curs.execute('SELECT * FROM routes')
-    res = curs.fetchall()
-    conn.close()
-    routes = [
-    {
-        'id' : route_id,
-        'router_ip' : router_ip,
-        'prefix_id' : prefix_id,
-        'next_hop' : next_hop,
-        'balancing' : balancing
-    } for route_id, router_ip, prefix_id, next_hop, balancing in res
-    ]
-    #return jsonify({'routes': [route_to_dict(route) for route in routes]})
-    return jsonify({'routes': [make_public_route(route) for route in routes]}), 200
+    etag = collection_etag(curs, 'routes', 'routers')
+    if request.if_none_match.contains(etag):
+        return not_modified(etag)
+    where, args = collection_filters({ 'router_ip': 'routes.router_ip',
+        'prefix_id': 'routes.prefix_id', 'next_hop': 'routes.next_hop', 'layer': 'routers.layer' })
+    query = 'SELECT routes.* FROM routes'
+    if 'layer' in request.args:
+        query += ' JOIN routers ON routers.public_ip = routes.router_ip'
+    res, next_cursor = fetch_page(curs, query, 'routes.id', where, args)
+    routes = (make_public_route(route_to_dict(route)) for route in res)
+    return collection_response('routes', routes, next_cursor, etag)
 
 @app.route('/icnaas/api/v1.0/routes/<route_id>', methods=['GET'])
 def get_route(route_id):
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
     t = (route_id,)
     curs.execute('SELECT * FROM routes WHERE id = ?', t)
     route = curs.fetchone()
-    conn.close()
     if route is None:
         abort(404)
     return jsonify({'route': route_to_dict(route)}), 200
@@ -441,7 +586,7 @@ def make_public_route(route):
     new_route= {}
     for field in route:
         if field == 'id':
-            new_route['uri'] = url_for('get_route', route_id=route['id'], _external=True)
+            new_route['uri'] = resource_uri('get_route', route['id'])
         else:
             new_route[field] = route[field]
     return new_route
@@ -456,13 +601,360 @@ def route_to_dict(route):
     }
     return out
 
+def collection_etag(curs, *tables):
+    # changes whenever one of the tables does, and differs per page and filter
+    curs.execute('SELECT name, version FROM table_versions WHERE name IN (%s) ORDER BY name'
+        % ','.join('?' * len(tables)), tables)
+    versions = '-'.join('%s%d' % row for row in curs.fetchall())
+    query = hashlib.md5(request.query_string).hexdigest()[:12]
+    return '%s-%s' % (versions, query)
+
+def not_modified(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    return response
+
+def collection_filters(columns):
+    # equality filters from the query string, for the given arg -> column map
+    where = []
+    args = []
+    for arg in sorted(columns):
+        if arg in request.args:
+            where.append(columns[arg] + ' = ?')
+            args.append(request.args[arg])
+    return where, args
+
+def fetch_page(curs, query, key, where, args):
+    """
+    Run query ordered by key, returning (rows, next_cursor). Without a
+    limit argument every row is returned, as before pagination existed,
+    and rows is the cursor itself so they are read while streaming.
+    """
+    where = list(where)
+    args = list(args)
+    if 'cursor' in request.args:
+        where.append(key + ' > ?')
+        args.append(request.args['cursor'])
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY ' + key
+    limit = None
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+        limit = min(limit, LIST_MAX_LIMIT)
+        query += ' LIMIT %d' % (limit + 1)
+    curs.execute(query, args)
+    if limit is None:
+        return curs, None
+    res = curs.fetchall()
+    next_cursor = None
+    if len(res) > limit:
+        res = res[:limit]
+        next_cursor = res[-1][0]
+    return res, next_cursor
+
+def collection_response(name, items, next_cursor, etag):
+    """
+    Stream items, an iterable of dicts, as a JSON object { name: [...] } or,
+    when the client prefers it, as one JSON object per line (NDJSON).
+    """
+    extra = {}
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args['cursor'] = next_cursor
+        extra = { 'next_cursor': next_cursor,
+            'next': url_for(request.endpoint, _external=True, **args) }
+    mimetype = request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE])
+    if mimetype == NDJSON_MIMETYPE:
+        body = stream_ndjson(items)
+    else:
+        mimetype = 'application/json'
+        body = stream_json(name, items, extra)
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    if extra:
+        response.headers['Link'] = '<%s>; rel="next"' % extra['next']
+    response.set_etag(etag)
+    return response
+
+def stream_chunks(lines):
+    # group rows so each write to the client carries more than one of them
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == STREAM_CHUNK_ROWS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def stream_json(name, items, extra):
+    yield '{%s: [' % json.dumps(name)
+    separators = ('\n' if i == 0 else ',\n' for i in itertools.count())
+    for chunk in stream_chunks(sep + json.dumps(item, sort_keys=True)
+            for sep, item in itertools.izip(separators, items)):
+        yield chunk
+    yield '\n]'
+    for key in sorted(extra):
+        yield ', %s: %s' % (json.dumps(key), json.dumps(extra[key]))
+    yield '}\n'
+
+def stream_ndjson(items):
+    for chunk in stream_chunks(json.dumps(item, sort_keys=True) + '\n' for item in items):
+        yield chunk
+
+def resource_uri(endpoint, resource_id):
+    # url_for once per request and endpoint, not once per row of a listing
+    bases = getattr(g, 'resource_uris', None)
+    if bases is None:
+        bases = g.resource_uris = {}
+    if endpoint not in bases:
+        marker = '__id__'
+        arg = { 'get_router': 'router_id', 'get_prefix': 'prefix_id', 'get_route': 'route_id' }[endpoint]
+        bases[endpoint] = url_for(endpoint, _external=True, **{ arg: marker }).split(marker)
+    base = bases[endpoint]
+    return base[0] + str(resource_id) + base[1]
+
+@app.route('/icnaas/api/v1.0/jobs', methods=['GET'])
+def get_jobs():
+    jobs = routejobs.list_jobs(get_db().cursor())
+    return jsonify({'jobs': [make_public_job(job) for job in jobs]}), 200
+
+@app.route('/icnaas/api/v1.0/jobs/<int:job_id>', methods=['GET'])
+def get_job(job_id):
+    job = routejobs.get_job(get_db().cursor(), job_id)
+    if job is None:
+        abort(404)
+    return jsonify({'job': make_public_job(job)}), 200
+
+def make_public_job(job):
+    new_job = dict(job)
+    new_job['uri'] = url_for('get_job', job_id=job['id'], _external=True)
+    return new_job
+
+def job_accepted(out, job):
+    # DB changes are committed, routes are applied by the job in the background
+    if is_dry_run():
+        # nothing was committed, job is the plan of what would have been pushed
+        out['plan'] = job
+        return jsonify(out), 200
+    out['job'] = make_public_job(job)
+    response = jsonify(out)
+    response.status_code = 202
+    response.headers['Location'] = out['job']['uri']
+    return response
+
+@app.route('/icnaas/api/v1.0/reconciler', methods=['GET'])
+def get_reconciler():
+    out = {
+        'enabled' : route_reconciler.is_alive(),
+        'active' : route_jobs.is_leader(),
+        'interval' : route_reconciler.interval,
+        'last_round' : route_reconciler.last_round
+    }
+    return jsonify({'reconciler': out}), 200
+
+# event type -> table, key column, key type and row formatting; route events
+# are only left from before migration 9
+EVENT_ENTITIES = OrderedDict([
+    ('router', ('routers', 'public_ip', unicode, router_to_dict, make_public_router)),
+    ('prefix', ('prefixes', 'id', int, prefix_to_dict, make_public_prefix)),
+    ('route', ('routes', 'id', int, route_to_dict, make_public_route)),
+])
+# event type of the routes of one router changing, keyed by its public ip
+ROUTES_EVENT = 'routes'
+
+event_waiters = threading.BoundedSemaphore(EVENT_MAX_WAITERS)
+
+@app.route('/icnaas/api/v1.0/events', methods=['GET'])
+def get_events():
+    """
+    Router, prefix and route change events after sequence number since (or
+    Last-Event-ID), as a JSON long poll waiting up to wait seconds, or as a
+    server-sent event stream. Without since, events start from now.
+    """
+    curs = get_db().cursor()
+    since = event_since()
+    stream = request.accept_mimetypes.best_match(['application/json', EVENT_STREAM_MIMETYPE]) \
+        == EVENT_STREAM_MIMETYPE
+    if stream:
+        return Response(stream_with_context(stream_events(since)), mimetype=EVENT_STREAM_MIMETYPE,
+            headers={ 'Cache-Control': 'no-cache' })
+
+    limit = EVENT_BATCH
+    if 'limit' in request.args:
+        try:
+            limit = int(request.args['limit'])
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+        limit = min(limit, EVENT_BATCH)
+    try:
+        wait = min(float(request.args.get('wait', 0)), EVENT_MAX_WAIT)
+    except ValueError:
+        abort(400)
+    # a waiting poll holds a worker thread, beyond EVENT_MAX_WAITERS it does not wait
+    waiting = wait > 0 and event_waiters.acquire(False)
+    try:
+        deadline = time.time() + (wait if waiting else 0)
+        while True:
+            first, last = event_bounds(curs)
+            if since is None:
+                since = last
+            if since < first - 1:
+                # the events after since were discarded, the consumer has to resync
+                return jsonify({'error': 'Events after %d are no longer available' % since,
+                    'first_seq': first, 'last_seq': last}), 410
+            events = read_events(curs, since, limit)
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                break
+            wait_for_change(min(remaining, EVENT_POLL_INTERVAL))
+    finally:
+        if waiting:
+            event_waiters.release()
+    last_seq = events[-1]['seq'] if events else since
+    return jsonify({'events': events, 'last_seq': last_seq}), 200
+
+def stream_events(since):
+    # beyond EVENT_MAX_WAITERS a stream sends what is there and closes, the
+    # client reconnects after EVENT_BUSY_RETRY with Last-Event-ID
+    waiting = event_waiters.acquire(False)
+    try:
+        curs = get_db().cursor()
+        started = time.time()
+        sent = started
+        yield 'retry: %d\n\n' % ((EVENT_POLL_INTERVAL if waiting else EVENT_BUSY_RETRY) * 1000)
+        while True:
+            first, last = event_bounds(curs)
+            if since is None:
+                since = last
+            if since < first - 1:
+                yield sse_event(last, 'reset', {'first_seq': first, 'last_seq': last})
+                since = last
+                sent = time.time()
+                continue
+            events = read_events(curs, since, EVENT_BATCH)
+            if events:
+                yield ''.join(sse_event(event['seq'], event['type'] + '.' + event['action'], event)
+                    for event in events)
+                since = events[-1]['seq']
+                sent = time.time()
+                continue
+            if not waiting or time.time() - started >= EVENT_STREAM_DURATION:
+                break
+            if time.time() - sent >= EVENT_KEEPALIVE:
+                yield ': keepalive\n\n'
+                sent = time.time()
+            wait_for_change(EVENT_POLL_INTERVAL)
+    finally:
+        if waiting:
+            event_waiters.release()
+
+def sse_event(seq, name, data):
+    return 'id: %d\nevent: %s\ndata: %s\n\n' % (seq, name, json.dumps(data, sort_keys=True))
+
+def event_since():
+    value = request.args.get('since', request.headers.get('Last-Event-ID'))
+    if value is None or value == '':
+        return None
+    try:
+        since = int(value)
+    except ValueError:
+        abort(400)
+    if since < 0:
+        abort(400)
+    return since
+
+def event_bounds(curs):
+    # (first, last) sequence numbers still stored, first is last + 1 when there are none
+    curs.execute("SELECT MIN(seq), MAX(seq), \
+        (SELECT seq FROM sqlite_sequence WHERE name = 'change_events') FROM change_events")
+    first, last, counter = curs.fetchone()
+    last = last if last is not None else (counter or 0)
+    return (first if first is not None else last + 1), last
+
+def read_events(curs, since, limit):
+    """
+    Up to limit events after since. Events carry the current state of the
+    row they refer to, or null once it is gone, so applying them in order
+    converges on the tables even when several changes are coalesced.
+    """
+    t = (since, limit)
+    curs.execute('SELECT seq, created, entity, action, key, old_key FROM change_events \
+        WHERE seq > ? ORDER BY seq LIMIT ?', t)
+    rows = curs.fetchall()
+    keys = {}
+    for row in rows:
+        if row[3] != 'delete':
+            keys.setdefault(row[2], set()).add(row[4])
+    current = {}
+    for entity, (table, column, key_type, to_dict, make_public) in EVENT_ENTITIES.items():
+        found = load_rows(curs, table, column, sorted(keys.get(entity, ())))
+        current[entity] = dict((unicode(row[0]), make_public(to_dict(row))) for row in found)
+    current[ROUTES_EVENT] = dict((router_ip, routes_summary(router_ip, count))
+        for router_ip, count in count_routes(curs, sorted(keys.get(ROUTES_EVENT, ()))).items())
+    events = []
+    for seq, created, entity, action, key, old_key in rows:
+        key_type = EVENT_ENTITIES[entity][2] if entity in EVENT_ENTITIES else unicode
+        event = { 'seq': seq, 'time': created, 'type': entity, 'action': action, 'key': key_type(key),
+            'data': current[entity].get(key) if action != 'delete' else None }
+        if old_key is not None and old_key != key:
+            event['old_key'] = key_type(old_key)
+        events.append(event)
+    return events
+
+def count_routes(curs, router_ips):
+    # router ip -> number of routes, for every router in router_ips
+    counts = dict((router_ip, 0) for router_ip in router_ips)
+    for i in range(0, len(router_ips), 500):
+        batch = router_ips[i:i + 500]
+        curs.execute('SELECT router_ip, COUNT(*) FROM routes WHERE router_ip IN (%s) GROUP BY router_ip'
+            % ','.join('?' * len(batch)), batch)
+        counts.update(curs.fetchall())
+    return counts
+
+def routes_summary(router_ip, count):
+    # the routes themselves are listed by the routes endpoint
+    return { 'router_ip': router_ip, 'count': count,
+        'uri': url_for('get_routes', router_ip=router_ip, _external=True) }
+
+def record_route_events(curs, router_ips):
+    # one event per router and commit, a bulk change would flood the history with one per route
+    t = time.time()
+    curs.executemany('INSERT INTO change_events (created, entity, action, key) VALUES (?,?,?,?)',
+        [(t, ROUTES_EVENT, 'update', router_ip) for router_ip in sorted(router_ips)])
+
+def load_rows(curs, table, column, keys):
+    # in batches below SQLITE_MAX_VARIABLE_NUMBER
+    rows = []
+    for i in range(0, len(keys), 500):
+        batch = keys[i:i + 500]
+        curs.execute('SELECT * FROM %s WHERE %s IN (%s)' % (table, column, ','.join('?' * len(batch))),
+            batch)
+        rows.extend(curs.fetchall())
+    return rows
+
+def wait_for_change(timeout):
+    # woken at once by commits of this process, otherwise after timeout
+    with change_condition:
+        change_condition.wait(timeout)
+
+def notify_change():
+    with change_condition:
+        change_condition.notify_all()
+
 @app.route('/icnaas/api/v1.0/endpoints/client', methods=['GET'])
 def get_client_endpoints():
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
     curs.execute('SELECT * FROM routers WHERE layer = 0')
     res = curs.fetchall()
-    conn.close()
     routers = [
     {
         'public_ip' : public_ip, 
@@ -476,15 +968,65 @@ def get_client_endpoints():
     #return jsonify({'routers': [router_to_dict(router) for router in routers]})
     return jsonify({'routers': [make_public_router(router) for router in routers]}), 200
 
+@app.route('/icnaas/api/v1.0/endpoints/client/nearest', methods=['GET'])
+def get_nearest_client_endpoints():
+    try:
+        x = float(request.args['x'])
+        y = float(request.args['y'])
+        k = int(request.args.get('k', 1))
+    except (KeyError, ValueError):
+        abort(400)
+    if k <= 0 or not spatial.finite(x) or not spatial.finite(y):
+        abort(400)
+    k = min(k, LIST_MAX_LIMIT)
+
+    curs = get_db().cursor()
+    version = table_version(curs, 'routers')
+    if edge_index.version != version:
+        curs.execute('SELECT * FROM routers WHERE layer = ?', (spatial.EDGE_LAYER,))
+        edge_index.load(curs.fetchall(), version)
+    routers = []
+    for distance, router in edge_index.nearest(x, y, k):
+        router = make_public_router(router_to_dict(router))
+        router['distance'] = distance
+        routers.append(router)
+    return jsonify({'routers': routers}), 200
+
+def commit_routers(conn, changes):
+    # commit (old router, new router) changes and apply them to the in-memory views
+    curs = conn.cursor()
+    route_changes = get_route_changes()
+    route_changes.touched('routers')
+    bump_versions(curs, route_changes.take_tables())
+    version = table_version(curs, 'routers')
+    job = commit_route_changes(conn)
+    edge_index.apply(version, [(old[0] if old is not None else None, new) for old, new in changes])
+    router_cache.invalidate(version, changes)
+    return job
+
+def current_routers_version():
+    return table_version(get_db().cursor(), 'routers')
+
+router_cache = routercache.RouterCache(current_routers_version)
+
+def table_version(curs, name):
+    t = (name,)
+    curs.execute('SELECT version FROM table_versions WHERE name = ?', t)
+    return curs.fetchone()[0]
+
+def bump_versions(curs, tables):
+    # once per table and transaction, a trigger per row made bulk writes several times slower
+    curs.executemany('UPDATE table_versions SET version = version + 1 WHERE name = ?',
+        [(name,) for name in sorted(tables)])
+
 @app.route('/icnaas/api/v1.0/endpoints/server', methods=['GET'])
 def get_server_endpoints():
-    conn = sqlite3.connect('routers.db')
+    conn = get_db()
     curs = conn.cursor()
     curs.execute('SELECT MAX(layer) AS layer FROM routers WHERE layer != 100')
     t = curs.fetchone()
     curs.execute('SELECT * FROM routers WHERE layer = ?', t)
     res = curs.fetchall()
-    conn.close()
     routers = [
     {
         'public_ip' : public_ip, 
@@ -498,250 +1040,510 @@ def get_server_endpoints():
     #return jsonify({'routers': [router_to_dict(router) for router in routers]})
     return jsonify({'routers': [make_public_router(router) for router in routers]}), 200
 
-def create_routes_router(public_ip, layer):
-    # SPECIAL CASE: no higher layer, exit
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-    t = (layer,)
-    curs.execute('SELECT * FROM routers WHERE layer > ?', t);
-    router = curs.fetchone()
-    if router is None:
-        return 0
+def sync_router_routes(topology, planned, router_ips):
+    # bring the routes of router_ips from topology in line with planned, a changed copy
+    curs = get_db().cursor()
+    adds, deletes = plan_router_routes(curs, topology, planned, router_ips)
+    remove_routes(curs, deletes)
+    add_routes(curs, planned, adds)
+    return 0
 
-    # if one exists at the same layer, copy from routes table
-    t = (layer, public_ip)
-    curs.execute('SELECT * FROM routers WHERE layer = ? AND public_ip NOT LIKE ?', t);
-    router = curs.fetchone()
-    if router is not None:
-        # copy from routes
-        t = (router[0],)
-        curs.execute('SELECT * FROM routes WHERE router_ip LIKE ?', t)
-        routes = curs.fetchall() 
-        for route in routes:
-            # add route to DB with router_ip as public_ip
-            new_route = (public_ip, route[2], route[3], route[4]);
-            curs.execute('PRAGMA foreign_keys = ON')
-            curs.execute('INSERT INTO routes (router_ip, prefix_id, \
-                next_hop, balancing) VALUES (?,?,?,?)', new_route)
-            conn.commit()
-            # add route to router via SSH
-            p = (route[2],)
-            curs.execute('SELECT url, balancing FROM prefixes WHERE id = ?', p)
-            prefix = curs.fetchone()
-            add_route_ssh(new_route, prefix[0], prefix[1])
+def plan_router_routes(curs, topology, planned, router_ips):
+    """
+    Routes to add and delete when the routers change from topology to
+    planned, from the next hops each of router_ips gains and loses: only the
+    routes to lost next hops are read, not every route of the neighbourhood.
+    Returns (adds, deletes) as diff_routes does.
+    """
+    changes = topology.edge_changes(planned, router_ips)
+    # the layer below a next hop loses it as a whole, its routes are read once
+    losing = {}
+    for router_ip, added, removed in changes:
+        if planned.next_hops(router_ip):
+            for next_hop in removed:
+                losing.setdefault(next_hop, set()).add(router_ip)
+    lost = {}
+    for next_hop, routers in sorted(losing.items()):
+        for route in select_next_hop_routes(curs, next_hop):
+            if route[1] in routers:
+                lost.setdefault(route[1], []).append(route)
+    adds = []
+    deletes = []
+    for router_ip, added, removed in changes:
+        if planned.next_hops(router_ip):
+            routes = lost.get(router_ip, [])
+        else:
+            # a router without next hops loses all of its routes
+            routes = select_routes(curs, [router_ip])
+        deletes.extend(sorted(routes, key=lambda route: (int(route[2]), route[3])))
+        adds.extend((router_ip, prefix_id, next_hop) for prefix_id in sorted(planned.prefixes)
+            for next_hop in sorted(added))
+    return adds, deletes
+
+def select_routes(curs, router_ips=None, prefix_ids=None):
+    # current routes with their prefix url, looked up through the routes indexes
+    query = 'SELECT routes.*, prefixes.url FROM routes \
+        JOIN prefixes ON prefixes.id = routes.prefix_id'
+    routes = []
+    if router_ips is not None:
+        for router_ip in router_ips:
+            t = (router_ip,)
+            curs.execute(query + ' WHERE routes.router_ip = ?', t)
+            routes.extend(curs.fetchall())
+    elif prefix_ids is not None:
+        for prefix_id in prefix_ids:
+            t = (prefix_id,)
+            curs.execute(query + ' WHERE routes.prefix_id = ?', t)
+            routes.extend(curs.fetchall())
     else:
-        # otherwise, get list of next layer public_ips and iterate through all prefixes to create routes
-        t = (int(layer),)
-        curs.execute('SELECT DISTINCT(layer) FROM routers WHERE layer > ? ORDER BY layer ASC', t)
-        next_layer = curs.fetchone()[0]
-        t = (next_layer,)
-        curs.execute('SELECT public_ip FROM routers WHERE layer = ?', t)
-        ips = curs.fetchall()
-        for ip in ips:
-            curs.execute('SELECT * FROM prefixes')
-            prefixes = curs.fetchall()
-            for prefix in prefixes:
-                route = (public_ip, prefix[0], ip[0], 0)
-                curs.execute('PRAGMA foreign_keys = ON')
-                curs.execute('INSERT INTO routes (router_ip, prefix_id, \
-                    next_hop, balancing) VALUES (?,?,?,?)', route)
-                conn.commit()
-                # add route to router via SSH
-                add_route_ssh(route, prefix[1], prefix[2])
-    conn.close()
-    return 0
+        curs.execute(query)
+        routes = curs.fetchall()
+    return routes
 
-def delete_routes_router(public_ip):
-    # iterate over all routes where router_ip = public_ip
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()   
+def select_next_hop_routes(curs, next_hop):
+    t = (next_hop,)
+    curs.execute('SELECT routes.*, prefixes.url FROM routes \
+        JOIN prefixes ON prefixes.id = routes.prefix_id WHERE routes.next_hop = ?', t)
+    return curs.fetchall()
 
-    t = (public_ip,)
-    curs.execute('SELECT * FROM routes WHERE router_ip LIKE ?', t)
-    routes = curs.fetchall()
+def remove_routes(curs, routes):
     for route in routes:
-        p = (route[2],)
-        curs.execute('SELECT url FROM prefixes WHERE id = ?', p)
         # delete route from router via SSH
-        delete_route_ssh(route, curs.fetchone()[0])
-    curs.execute('PRAGMA foreign_keys = ON')
-    curs.execute('DELETE FROM routes WHERE router_ip LIKE ?', t)
-    conn.commit()
-    conn.close()
-    return 0
-
-def create_routes_prefix(prefix_id, prefix_url, prefix_balancing):
-    # iterate over all routes (by next_hop), add another with prefix_id
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-
-    curs.execute('SELECT * FROM routes')
-    route = curs.fetchone()
-    # if routes already exist (not first prefix)
-    if route is not None:
-        curs.execute('SELECT public_ip FROM routers')
-        ips = curs.fetchall()
-        for ip in ips:
-            t = (ip[0],)
-            curs.execute('SELECT prefix_id FROM routes WHERE router_ip LIKE ?', t)
-            base = curs.fetchone()
-            if base is not None:
-                t = (ip[0], base[0])
-                curs.execute('SELECT * FROM routes WHERE router_ip LIKE ? AND prefix_id = ?', t)
-                routes = curs.fetchall()
-                for route in routes:
-                    new_route = (ip[0], prefix_id, route[3], route[4])
-                    curs.execute('PRAGMA foreign_keys = ON')
-                    curs.execute('INSERT INTO routes (router_ip, prefix_id, \
-                        next_hop, balancing) VALUES (?,?,?,?)', new_route)
-                    conn.commit()
-                    # add route to router via SSH
-                    add_route_ssh(new_route, prefix_url, prefix_balancing)
-    else:
-        # Get layers
-        curs.execute('SELECT DISTINCT(layer) FROM routers ORDER BY layer ASC')
-        layers = curs.fetchall()
-        for element in range(0, len(layers) - 1):
-            create_routes_layer_multiple(layers[element][0], layers[element + 1][0]);
-    conn.close()
-    return 0
-
-def create_routes_layer_single(layer, public_ip, dst_layer):
-    # iterate through all prefixes, add routes to routers of layer with next_hop public_ip
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-
-    curs.execute('SELECT id, url, balancing FROM prefixes')
-    prefixes = curs.fetchall()
-    for prefix in prefixes:
-        t = (layer,)
-        curs.execute('SELECT public_ip FROM routers WHERE layer = ?', t)
-        ips = curs.fetchall()
-        for ip in ips:
-            route = (ip[0], prefix[0], public_ip, 0)
-            curs.execute('PRAGMA foreign_keys = ON')
-            curs.execute('INSERT INTO routes (router_ip, prefix_id, \
-                next_hop, balancing) VALUES (?,?,?,?)', route)
-            conn.commit()
-            # add route to router via SSH
-            add_route_ssh(route, prefix[1], prefix[2])
-
-
-    # if routes exist to layer above the layer of router with public_ip, remove
-    t = (layer,)
-    curs.execute('SELECT public_ip FROM routers WHERE layer = ?', t)
-    ips_layer = curs.fetchall()
-    for ip_layer in ips_layer:
-        t = (dst_layer,)
-        curs.execute('SELECT public_ip FROM routers WHERE layer > ?', t)
-        ips_layer2 = curs.fetchall()
-        for ip_layer2 in ips_layer2:
-            t = (ip_layer[0], ip_layer2[0])
-            curs.execute('SELECT * FROM routes WHERE router_ip LIKE ? AND next_hop LIKE ?', t)
-            routes = curs.fetchall()
-            for route in routes:
-                p = (route[2],)
-                curs.execute('SELECT url FROM prefixes WHERE id = ?', p)
-                # delete route from router via SSH
-                delete_route_ssh(route, curs.fetchone()[0])
-            curs.execute('PRAGMA foreign_keys = ON')
-            curs.execute('DELETE FROM routes WHERE router_ip LIKE ? AND next_hop LIKE ?', t)
-            conn.commit()
-    conn.close()
-    return 0
-
-def create_routes_layer_multiple(layer_src, layer_dst):
-    # get list of layer_src/layer_dst public_ips and iterate through all prefixes to create routes at layer_src routers
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-
-    t = (layer_src,)
-    curs.execute('SELECT public_ip FROM routers WHERE layer = ?', t)
-    ips_src = curs.fetchall()
-
-    t = (layer_dst,)
-    curs.execute('SELECT public_ip FROM routers WHERE layer = ?', t)
-    ips_dst = curs.fetchall()
-
-    curs.execute('SELECT id, url, balancing FROM prefixes')
-    prefixes = curs.fetchall()
-    for prefix in prefixes:
-        for ip_src in ips_src:
-            for ip_dst in ips_dst:
-                route = (ip_src[0], prefix[0], ip_dst[0], 0)
-                curs.execute('PRAGMA foreign_keys = ON')
-                curs.execute('INSERT INTO routes (router_ip, prefix_id, \
-                    next_hop, balancing) VALUES (?,?,?,?)', route)
-                conn.commit()
-                # add route to router via SSH
-                add_route_ssh(route, prefix[1], prefix[2])
-    conn.close()
-    return 0
-
-def delete_routes_dst(public_ip):
-    # delete all routes with public_ip = next_hop.
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-
-    t = (public_ip,)
-    curs.execute('SELECT * FROM routes WHERE next_hop LIKE ?', t)
+        delete_route_ssh(route, route[5])
+    curs.executemany('DELETE FROM routes WHERE id = ?', [(route[0],) for route in routes])
+    get_route_changes().routes_changed(route[1] for route in routes)
+
+def add_routes(curs, topology, routes):
+    new_routes = []
+    for router_ip, prefix_id, next_hop in routes:
+        prefix = topology.prefixes[prefix_id]
+        route = (router_ip, prefix_id, next_hop, route_weight(prefix))
+        new_routes.append(route)
+        # add route to router via SSH
+        add_route_ssh(route, prefix[0])
+    insert_routes(curs, new_routes)
+
+def route_weight(prefix):
+    """
+    routes.balancing of the routes of prefix, (url, balancing, strategy,
+    ...): the prefix balancing, at least 1, with a load-balancing strategy,
+    0 otherwise.
+    """
+    if prefix[2] not in BALANCING_STRATEGIES:
+        return 0
+    return max(int(prefix[1]), 1)
+
+def refresh_prefix_routes(curs, old_prefix, new_prefix):
+    # re-announce all routes of a prefix whose url changed, re-apply its strategy
+    url_changed = old_prefix[1] != new_prefix[1]
+    strategy_changed = old_prefix[3:5] != new_prefix[3:5]
+    t = (new_prefix[0],)
+    if route_weight(old_prefix[1:]) != route_weight(new_prefix[1:]):
+        data = (route_weight(new_prefix[1:]), new_prefix[0])
+        curs.execute('UPDATE routes SET balancing = ? WHERE prefix_id = ?', data)
+        curs.execute('SELECT DISTINCT router_ip FROM routes WHERE prefix_id = ?', t)
+        get_route_changes().routes_changed(row[0] for row in curs.fetchall())
+    if not url_changed and not strategy_changed:
+        return 0
+    if url_changed:
+        # ccnd keeps the strategy on the old name
+        changes = get_route_changes()
+        curs.execute('SELECT router_ip FROM router_strategies WHERE prefix_id = ?', t)
+        for row in curs.fetchall():
+            changes.add(row[0], ccndc_removestrategy(old_prefix[1]))
+        curs.execute('DELETE FROM router_strategies WHERE prefix_id = ?', t)
+    curs.execute('SELECT * FROM routes WHERE prefix_id = ?', t)
     routes = curs.fetchall()
     for route in routes:
-        p = (route[2],)
-        curs.execute('SELECT url FROM prefixes WHERE id = ?', p)
-        # delete route from router via SSH
-        delete_route_ssh(route, curs.fetchone()[0])
-    curs.execute('PRAGMA foreign_keys = ON')
-    curs.execute('DELETE FROM routes WHERE next_hop LIKE ?', t)
-    conn.commit()
-    conn.close()
+        if url_changed:
+            delete_route_ssh(route, old_prefix[1])
+            add_route_ssh(route[1:], new_prefix[1])
+        else:
+            get_route_changes().routed(route[1], route[2])
     return 0
 
-def delete_routes_prefix(prefix_id, prefix_url):
-    # delete all routes with prefix_id = prefix_id.
-    conn = sqlite3.connect('routers.db')
-    curs = conn.cursor()
-
-    t = (prefix_id,)
-    curs.execute('SELECT * FROM routes WHERE prefix_id LIKE ?', t)
+def sync_strategies(curs, routed):
+    """
+    Give every (router_ip, prefix_id) in routed the strategy of its prefix,
+    unless router_strategies says the router already has it.
+    """
+    if not routed:
+        return
+    select_prefix_batch(curs, set(prefix_id for router_ip, prefix_id in routed))
+    curs.execute('SELECT * FROM prefixes WHERE id IN (SELECT id FROM temp.prefix_batch)')
+    prefixes = dict((row[0], tuple(row[1:])) for row in curs.fetchall())
+    removed, changed = strategy_changes(curs, prefixes, routed)
+    curs.executemany('DELETE FROM router_strategies WHERE router_ip = ? AND prefix_id = ?', removed)
+    curs.executemany('INSERT OR REPLACE INTO router_strategies VALUES (?,?,?,?)', changed)
+
+def strategy_changes(curs, prefixes, routed, forgotten=()):
+    """
+    Queue the strategy commands routed needs, with prefixes as prefix id ->
+    (url, balancing, strategy, strategy_parameters). Strategies recorded
+    for the prefixes in forgotten count as gone. Returns the
+    router_strategies rows to delete and to insert or replace.
+    """
+    changes = get_route_changes()
+    select_prefix_batch(curs, set(prefix_id for router_ip, prefix_id in routed))
+    select_router_batch(curs, set(router_ip for router_ip, prefix_id in routed))
+    curs.execute('SELECT router_ip, prefix_id, strategy, parameters FROM router_strategies \
+        WHERE prefix_id IN (SELECT id FROM temp.prefix_batch) \
+        AND router_ip IN (SELECT public_ip FROM temp.router_batch)')
+    current = dict(((row[0], row[1]), tuple(row[2:])) for row in curs.fetchall()
+        if row[1] not in forgotten)
+    removed = []
+    changed = []
+    for router_ip, prefix_id in sorted(routed):
+        if prefix_id not in prefixes:
+            continue
+        url, balancing, strategy, parameters = prefixes[prefix_id][:4]
+        if current.get((router_ip, prefix_id), ('default', None)) == (strategy, parameters):
+            continue
+        if strategy == 'default':
+            changes.add(router_ip, ccndc_removestrategy(url))
+            removed.append((router_ip, prefix_id))
+        else:
+            changes.add(router_ip, ccndc_setstrategy(url, strategy, parameters))
+            changed.append((router_ip, prefix_id, strategy, parameters))
+    return removed, changed
+
+def import_prefixes(curs, data):
+    """
+    Insert (url, balancing, strategy, strategy_parameters) prefixes and
+    their routes on all routers,
+    aborting with 409 if a url already exists. Returns the new rows.
+    """
+    prefix_ids = []
+    try:
+        for prefix in data:
+            curs.execute('INSERT INTO prefixes (url, balancing, strategy, strategy_parameters) \
+                VALUES (?,?,?,?)', prefix)
+            prefix_ids.append(curs.lastrowid)
+    except sqlite3.IntegrityError:
+        abort(409)
+    get_route_changes().touched('prefixes')
+    select_prefix_batch(curs, prefix_ids)
+
+    # every router gets every new prefix towards each router of the next
+    # populated layer above its own, as in Topology.desired_routes
+    # routes.balancing as in route_weight
+    curs.execute('INSERT INTO routes (router_ip, prefix_id, next_hop, balancing) \
+        SELECT routers.public_ip, prefixes.id, next_hops.public_ip, \
+            CASE WHEN prefixes.strategy IN (%s) THEN MAX(prefixes.balancing, 1) ELSE 0 END \
+        FROM routers \
+        JOIN routers AS next_hops ON next_hops.layer = \
+            (SELECT MIN(layer) FROM routers AS higher WHERE higher.layer > routers.layer) \
+        JOIN prefixes ON prefixes.id IN (SELECT id FROM temp.prefix_batch)'
+        % ','.join("'%s'" % strategy for strategy in BALANCING_STRATEGIES))
+    curs.execute('SELECT routes.router_ip, routes.prefix_id, routes.next_hop, \
+        prefixes.url FROM routes \
+        JOIN prefixes ON prefixes.id = routes.prefix_id \
+        WHERE routes.prefix_id IN (SELECT id FROM temp.prefix_batch) \
+        ORDER BY routes.router_ip, routes.prefix_id, routes.next_hop')
     routes = curs.fetchall()
     for route in routes:
-        # delete route from router via SSH
-        delete_route_ssh(route, prefix_url)
-    curs.execute('PRAGMA foreign_keys = ON')
-    curs.execute('DELETE FROM routes WHERE prefix_id LIKE ?', t)
-    conn.commit()
-    conn.close()
-    return 0
-
-def add_route_ssh(route, prefix_url, balancing):
+        add_route_ssh(route[:3], route[3])
+    get_route_changes().routes_changed(route[0] for route in routes)
+
+    curs.execute('SELECT * FROM prefixes WHERE id IN (SELECT id FROM temp.prefix_batch) ORDER BY id')
+    return curs.fetchall()
+
+def remove_prefixes(curs, prefix_ids):
+    """
+    Delete the prefixes and their routes on all routers. Returns the number
+    of prefixes that existed.
+    """
+    select_prefix_batch(curs, prefix_ids)
+    curs.execute('SELECT routes.*, prefixes.url FROM routes \
+        JOIN prefixes ON prefixes.id = routes.prefix_id \
+        WHERE routes.prefix_id IN (SELECT id FROM temp.prefix_batch) \
+        ORDER BY routes.router_ip, routes.prefix_id, routes.next_hop')
+    routes = curs.fetchall()
+    for route in routes:
+        delete_route_ssh(route, route[5])
+    get_route_changes().routes_changed(route[1] for route in routes)
+    curs.execute('SELECT router_strategies.router_ip, prefixes.url FROM router_strategies \
+        JOIN prefixes ON prefixes.id = router_strategies.prefix_id \
+        WHERE router_strategies.prefix_id IN (SELECT id FROM temp.prefix_batch)')
+    for router_ip, url in curs.fetchall():
+        get_route_changes().add(router_ip, ccndc_removestrategy(url))
+    curs.execute('DELETE FROM router_strategies WHERE prefix_id IN (SELECT id FROM temp.prefix_batch)')
+    curs.execute('DELETE FROM routes WHERE prefix_id IN (SELECT id FROM temp.prefix_batch)')
+    curs.execute('DELETE FROM prefixes WHERE id IN (SELECT id FROM temp.prefix_batch)')
+    if curs.rowcount:
+        get_route_changes().touched('prefixes')
+    return curs.rowcount
+
+def select_prefix_batch(curs, prefix_ids):
+    # the ids a bulk statement works on, in a table rather than a parameter list
+    curs.execute('DELETE FROM temp.prefix_batch')
+    curs.executemany('INSERT INTO temp.prefix_batch VALUES (?)', [(prefix_id,) for prefix_id in prefix_ids])
+
+def select_router_batch(curs, public_ips):
+    curs.execute('DELETE FROM temp.router_batch')
+    curs.executemany('INSERT INTO temp.router_batch VALUES (?)', [(public_ip,) for public_ip in public_ips])
+
+def insert_routes(curs, routes):
+    # all routes of one call in a single statement, committed with the request
+    curs.executemany('INSERT INTO routes (router_ip, prefix_id, \
+        next_hop, balancing) VALUES (?,?,?,?)', routes)
+    get_route_changes().routes_changed(route[0] for route in routes)
+
+def add_route_ssh(route, prefix_url):
+    # the strategy is set once per router and prefix, by sync_strategies
+    changes = get_route_changes()
     host = route[0]
-    cmd = '/home/centos/ccnx-0.8.2/bin/ccndc add ' + prefix_url \
-        + ' tcp ' + route[2] + ' 9695'
-    execute_ssh_command(host, cmd)
-    if int(balancing) > 0:
-        cmd2 = '/home/centos/ccnx-0.8.2/bin/ccndc setstrategy ' + prefix_url \
-        + ' loadsharing'
-        execute_ssh_command(host, cmd2)
+    changes.add(host, ccndc_add(prefix_url, route[2]))
+    changes.routed(host, route[1])
     return 0
 
 def delete_route_ssh(route, prefix_url):
+    changes = get_route_changes()
     host = route[1]
-    cmd = '/home/centos/ccnx-0.8.2/bin/ccndc del ' + prefix_url \
-        + ' tcp ' + route[3] + ' 9695'
-    execute_ssh_command(host, cmd)
+    changes.add(host, ccndc_del(prefix_url, route[3]))
     return 0
 
-def execute_ssh_command(host, command):
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    try:
-        ssh.connect(host, username='centos', key_filename='id_rsa', timeout=5)
-        stdin, stdout, stderr = ssh.exec_command(command)
-        #print stdout.readlines()
-        ssh.close()
-    except Exception as e:
-        print('SSH Connection Exception: %s: %s' % (e.__class__, e))
+def ccndc_add(prefix_url, next_hop):
+    return 'add ' + prefix_url + ' tcp ' + next_hop + ' 9695'
+
+def ccndc_del(prefix_url, next_hop):
+    return 'del ' + prefix_url + ' tcp ' + next_hop + ' 9695'
+
+def ccndc_setstrategy(prefix_url, strategy, parameters=None):
+    command = 'setstrategy ' + prefix_url + ' ' + strategy
+    if parameters:
+        command += ' ' + parameters
+    return command
+
+def ccndc_removestrategy(prefix_url):
+    return 'removestrategy ' + prefix_url
+
+class RouteChanges(object):
+    """
+    ccndc commands collected during one API call, grouped by router, so
+    that each router is reached once per call instead of once per route,
+    and the tables the call wrote to.
+    """
+
+    def __init__(self):
+        self.commands = OrderedDict()
+        # (host, prefix_id) pairs that got routes, their strategy is checked on commit
+        self.routed_prefixes = set()
+        # their table_versions are bumped once on commit
+        self.tables = set()
+        # routers whose routes were written, one routes event each on commit
+        self.route_routers = set()
+
+    def add(self, host, command):
+        self.commands.setdefault(host, []).append(command)
+
+    def routed(self, host, prefix_id):
+        self.routed_prefixes.add((host, int(prefix_id)))
+
+    def take_routed(self):
+        routed = self.routed_prefixes
+        self.routed_prefixes = set()
+        return routed
+
+    def touched(self, *tables):
+        self.tables.update(tables)
+
+    def routes_changed(self, router_ips):
+        router_ips = set(router_ips)
+        if router_ips:
+            self.tables.add('routes')
+            self.route_routers |= router_ips
+
+    def take_tables(self):
+        tables = self.tables
+        self.tables = set()
+        return tables
+
+    def take_route_routers(self):
+        route_routers = self.route_routers
+        self.route_routers = set()
+        return route_routers
+
+    def take(self):
+        commands = self.commands
+        self.commands = OrderedDict()
+        return commands
+
+def get_route_changes():
+    changes = getattr(g, 'route_changes', None)
+    if changes is None:
+        changes = RouteChanges()
+        g.route_changes = changes
+    return changes
+
+def commit_route_changes(conn):
+    # the job is stored with the change, so it is applied even if this process dies
+    changes = get_route_changes()
+    sync_strategies(conn.cursor(), changes.take_routed())
+    bump_versions(conn.cursor(), changes.take_tables())
+    record_route_events(conn.cursor(), changes.take_route_routers())
+    job = routejobs.create_job(conn.cursor(), changes.take())
+    t = (CHANGE_EVENT_HISTORY,)
+    conn.execute('DELETE FROM change_events WHERE seq <= (SELECT MAX(seq) FROM change_events) - ?', t)
+    conn.commit()
+    notify_change()
+    route_jobs.wake()
+    return job
+
+def is_dry_run():
+    # ?dry_run=true: the change is planned on a copy of the topology, nothing is written
+    return request.args.get('dry_run', '').lower() in ('1', 'true', 'yes')
+
+def dry_run_routes(curs, planned, router_ips, prefix_ids=None, current=None):
+    """
+    Plan the commands that bring the routes of router_ips (all if None) in
+    line with planned, a changed copy of the topology. current are the
+    routes to compare with, read from the database if None.
+    """
+    if current is None:
+        current = select_routes(curs, router_ips, prefix_ids)
+    adds, deletes = planned.diff_routes(current, router_ips, prefix_ids)
+    return dry_run_changes(curs, planned, adds, deletes)
+
+def dry_run_router_routes(curs, topology, planned, router_ips):
+    # plan sync_router_routes, planned is a changed copy of topology
+    adds, deletes = plan_router_routes(curs, topology, planned, router_ips)
+    return dry_run_changes(curs, planned, adds, deletes)
+
+def dry_run_changes(curs, planned, adds, deletes):
+    # the commands of routes adds and deletes, with the strategies they need
+    for route in deletes:
+        delete_route_ssh(route, route[5])
+    for route in adds:
+        add_route_ssh(route, planned.prefixes[route[1]][0])
+    return dry_run_plan(curs, planned.prefixes)
+
+def dry_run_plan(curs, prefixes, forgotten=()):
+    # strategies as sync_strategies would set them, with the planned prefixes
+    changes = get_route_changes()
+    strategy_changes(curs, prefixes, changes.take_routed(), forgotten)
+    return plan_route_changes(changes.take())
+
+def dry_run_import_prefixes(curs, data):
+    """
+    Plan import_prefixes: the new prefixes get ids of their own in a copy
+    of the topology, reported as None. Returns (prefix rows, plan).
+    """
+    topology = Topology.load(curs)
+    urls = [prefix[0] for prefix in data]
+    if len(set(urls)) != len(urls) or set(urls) & set(p[0] for p in topology.prefixes.values()):
+        abort(409)
+    planned = topology.copy()
+    prefix_ids = []
+    for prefix in data:
+        prefix_ids.append(-len(prefix_ids) - 1)
+        planned.add_prefix((prefix_ids[-1],) + prefix)
+    plan = dry_run_routes(curs, planned, None, prefix_ids, [])
+    return [(None,) + prefix for prefix in data], plan
+
+def dry_run_remove_prefixes(curs, prefix_ids):
+    # plan remove_prefixes, aborting with 404 if one of the prefixes does not exist
+    prefixes = Topology.load(curs).prefixes
+    if any(int(prefix_id) not in prefixes for prefix_id in prefix_ids):
+        abort(404)
+    for route in select_routes(curs, None, prefix_ids):
+        delete_route_ssh(route, route[5])
+    select_prefix_batch(curs, prefix_ids)
+    curs.execute('SELECT router_ip, prefix_id FROM router_strategies \
+        WHERE prefix_id IN (SELECT id FROM temp.prefix_batch)')
+    for router_ip, prefix_id in curs.fetchall():
+        get_route_changes().add(router_ip, ccndc_removestrategy(prefixes[prefix_id][0]))
+    return plan_route_changes(get_route_changes().take())
+
+def dry_run_update_prefix(curs, old_prefix, new_prefix):
+    # plan refresh_prefix_routes for the prefix row new_prefix
+    planned = Topology.load(curs)
+    planned.add_prefix(new_prefix)
+    url_changed = old_prefix[1] != new_prefix[1]
+    if not url_changed and old_prefix[3:5] == new_prefix[3:5]:
+        return plan_route_changes({})
+    t = (new_prefix[0],)
+    if url_changed:
+        curs.execute('SELECT router_ip FROM router_strategies WHERE prefix_id = ?', t)
+        for row in curs.fetchall():
+            get_route_changes().add(row[0], ccndc_removestrategy(old_prefix[1]))
+    curs.execute('SELECT * FROM routes WHERE prefix_id = ?', t)
+    for route in curs.fetchall():
+        if url_changed:
+            delete_route_ssh(route, old_prefix[1])
+            add_route_ssh(route[1:], new_prefix[1])
+        else:
+            get_route_changes().routed(route[1], route[2])
+    return dry_run_plan(curs, planned.prefixes, [new_prefix[0]] if url_changed else ())
+
+def plan_route_changes(commands):
+    """
+    Describe the commands a job would push (host -> ccndc commands) per
+    router, with an estimate of how long pushing them would take.
+    """
+    routers = []
+    for host, lines in commands.items():
+        planned = { 'router_ip': host, 'add': [], 'del': [], 'strategy': [], 'commands': len(lines) }
+        for line in lines:
+            words = line.split()
+            if words[0] in ('add', 'del'):
+                planned[words[0]].append({ 'prefix': words[1], 'next_hop': words[3] })
+            else:
+                planned['strategy'].append(line)
+        routers.append(planned)
+    return { 'routers': routers, 'cost': push_cost([len(lines) for lines in commands.values()]) }
+
+def push_cost(batches):
+    # batches are pushed by JOB_WORKERS threads, the longest first
+    slots = [0.0] * min(len(batches), routejobs.JOB_WORKERS)
+    for commands in sorted(batches, reverse=True):
+        slot = slots.index(min(slots))
+        slots[slot] += PUSH_SECONDS_PER_ROUTER + PUSH_SECONDS_PER_COMMAND * commands
+    return { 'routers': len(batches), 'commands': sum(batches), 'seconds': max(slots or [0.0]) }
+
+def get_router_lock(host):
+    with router_locks_lock:
+        return router_locks.setdefault(host, threading.Lock())
+
+def push_router_commands(host, commands):
+    # one batch at a time per router, so concurrent requests do not interleave
+    with get_router_lock(host):
+        return route_transport.push(host, commands)
+
+def read_router_fib(host):
+    return route_transport.read_fib(host)
+
+route_jobs = routejobs.RouteJobDispatcher(DATABASE, push_router_commands)
+
+def push_reconciled_routes(host, adds, deletes):
+    # repairs found by the reconciler go through the job queue like API changes
+    commands = [ccndc_del(url, next_hop) for url, next_hop in deletes]
+    strategies = OrderedDict()
+    for url, next_hop, strategy, parameters in adds:
+        commands.append(ccndc_add(url, next_hop))
+        if strategy != 'default':
+            # missing routes may mean ccnd restarted and lost its strategies too
+            strategies[url] = ccndc_setstrategy(url, strategy, parameters)
+    commands.extend(strategies.values())
+    route_jobs.submit(OrderedDict([(host, commands)]))
+
+route_reconciler = reconciler.RouteReconciler(DATABASE, read_router_fib, push_reconciled_routes,
+    route_jobs.last_job, route_jobs.is_idle, route_jobs.is_leader)
+
+def start_background():
+    # route jobs are applied by one process at a time, the others stand by
+    route_jobs.start()
+    if route_reconciler.interval > 0:
+        route_reconciler.start()
+
+def stop_background(timeout=None):
+    route_reconciler.stop()
+    if not route_jobs.stop(timeout):
+        print('Route job still running at shutdown, it will be applied again')
+
+atexit.register(stop_background)
 
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0')
+    init_db()
+    start_background()
+    app.run(debug=False, host='0.0.0.0', threaded=True)
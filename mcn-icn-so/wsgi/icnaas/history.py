@@ -0,0 +1,150 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@iam.unibe.ch"
+__status__ = "Production"
+
+"""
+Metric history for ICNaaS scaling decisions.
+Version 1.0
+"""
+
+import numpy
+
+# Samples (decision ticks) kept per router
+HISTORY_WINDOW = 60
+# Router slots allocated up front, doubled when they run out
+HISTORY_ROUTERS = 16
+
+class SampleHistory(object):
+    """
+    Ring buffer of the last window samples of every router, one array of
+    routers x ticks x metrics. Every tick is a column of all routers;
+    routers without a value in a tick have NaN there.
+    """
+
+    def __init__(self, metrics, window=HISTORY_WINDOW, routers=HISTORY_ROUTERS):
+        self.metrics = list(metrics)
+        self.window = window
+        self.samples = numpy.full((routers, window, len(self.metrics)), numpy.nan)
+        self.times = numpy.full(window, numpy.nan)
+        # public_ip -> row of samples
+        self.slots = {}
+        self.free = list(range(routers - 1, -1, -1))
+        # ticks recorded so far, the next one goes to ticks % window
+        self.ticks = 0
+
+    def record(self, timestamp, values):
+        """
+        Add one tick of { public_ip: { metric: value } }.
+        """
+        column = self.ticks % self.window
+        self.samples[:, column, :] = numpy.nan
+        self.times[column] = timestamp
+        for public_ip, router_values in values.items():
+            row = self.slot(public_ip)
+            self.samples[row, column, :] = [float(router_values[metric]) for metric in self.metrics]
+        self.ticks += 1
+
+    def slot(self, public_ip):
+        row = self.slots.get(public_ip)
+        if row is None:
+            if not self.free:
+                size = self.samples.shape[0]
+                self.samples = numpy.concatenate((self.samples, numpy.full(self.samples.shape, numpy.nan)))
+                self.free = list(range(2 * size - 1, size - 1, -1))
+            row = self.free.pop()
+            self.slots[public_ip] = row
+        return row
+
+    def sync(self, public_ips):
+        # forget the routers that are gone, their rows are reused
+        public_ips = set(public_ips)
+        for public_ip in [ip for ip in self.slots if ip not in public_ips]:
+            row = self.slots.pop(public_ip)
+            self.samples[row] = numpy.nan
+            self.free.append(row)
+
+    def series(self, public_ips, since=None):
+        """
+        Return (times, values), oldest first: the mean of the routers at
+        every tick after since, as a ticks x metrics array. Ticks without a
+        sample of any of the routers are left out.
+        """
+        rows = [self.slots[ip] for ip in public_ips if ip in self.slots]
+        if not rows:
+            return numpy.empty(0), numpy.empty((0, len(self.metrics)))
+        order = (numpy.arange(self.window) + self.ticks) % self.window
+        times = self.times[order]
+        block = self.samples[rows][:, order, :]
+        counts = (~numpy.isnan(block)).sum(axis=0)
+        values = numpy.where(counts > 0, numpy.nansum(block, axis=0) / numpy.maximum(counts, 1), numpy.nan)
+        keep = ~numpy.isnan(times) & (counts > 0).any(axis=1)
+        if since is not None:
+            # only compare the ticks that were recorded, NaN would warn
+            keep[keep] = times[keep] > since
+        return times[keep], values[keep]
+
+def valid_count(values):
+    return (~numpy.isnan(values)).sum(axis=0)
+
+def ewma(values, alpha):
+    """
+    Exponentially weighted moving average of every column, the newest
+    sample weighted alpha, ignoring NaN.
+    """
+    weights = alpha * (1 - alpha) ** numpy.arange(values.shape[0] - 1, -1, -1, dtype=float)
+    valid = ~numpy.isnan(values)
+    weights = weights[:, None] * valid
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (weights * numpy.where(valid, values, 0)).sum(axis=0) / weights.sum(axis=0)
+
+def percentile(values, q):
+    # q-th percentile of every column, ignoring NaN
+    if values.shape[0] == 0:
+        return numpy.full(values.shape[1:], numpy.nan)
+    return numpy.nanpercentile(values, q, axis=0)
+
+def slope(times, values):
+    """
+    Least squares slope of every column over times, per second, ignoring
+    NaN; NaN for columns with less than two samples.
+    """
+    valid = ~numpy.isnan(values)
+    t = numpy.where(valid, times[:, None], 0)
+    v = numpy.where(valid, values, 0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        count = valid.sum(axis=0)
+        t_mean = t.sum(axis=0) / count
+        v_mean = v.sum(axis=0) / count
+        dt = numpy.where(valid, t - t_mean, 0)
+        return (dt * (v - v_mean)).sum(axis=0) / (dt * dt).sum(axis=0)
+
+def forecast(times, values, horizon):
+    """
+    Value of every column horizon seconds after the last of times, on the
+    least squares line through its samples; NaN where slope is.
+    """
+    valid = ~numpy.isnan(values)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        count = valid.sum(axis=0)
+        t_mean = numpy.where(valid, times[:, None], 0).sum(axis=0) / count
+        v_mean = numpy.where(valid, values, 0).sum(axis=0) / count
+    return v_mean + slope(times, values) * (times[-1] + horizon - t_mean)
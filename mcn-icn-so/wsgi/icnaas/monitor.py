@@ -27,6 +27,7 @@ Version 1.2
 """
 
 from zabbix_api import ZabbixAPI
+import threading
 import time
 import traceback
 import sys
@@ -43,11 +44,85 @@ CCN_NUMBER_OF_INTERESTS = 5
 CCN_REPOSITORY_SIZE = 6
 CCN_TOTAL_NETWORK_TRAFFIC = 7
 
+# Zabbix item key of each metric
+ITEM_KEYS = {
+    CCN_ROUTER_CPU: "system.cpu.util[,idle]",
+    CCN_CACHE_SIZE: "ccnx.cache",
+    CCN_CCND_STATUS: "proc.num[ccnd]",
+    CCN_CCNR_STATUS: "proc.num[ccnr]",
+    CCN_NETWORK_DAEMON_STATUS: "net.udp.listen[9695]",
+    CCN_NUMBER_OF_INTERESTS: "ccnx.interests",
+    CCN_REPOSITORY_SIZE: "ccnx.repository",
+    CCN_TOTAL_NETWORK_TRAFFIC: "net.if.total[eth0]"
+}
+
+# Seconds the Zabbix host and item IDs of a router are used before they are resolved again
+MAAS_ID_CACHE_TTL = 600
+
+class MaaSIdCache(object):
+    """
+    Zabbix hostid and itemids (metric -> itemid) per public IP. Entries
+    expire after ttl seconds and are dropped by sync() when their router
+    is gone or replaced; monitors resolve them again on a miss.
+    """
+
+    def __init__(self, ttl=MAAS_ID_CACHE_TTL):
+        self.ttl = ttl
+        self.server = None
+        # public_ip -> (hostid, { metric: itemid }, resolved at)
+        self.entries = {}
+        # public_ip -> key of the router it belongs to
+        self.owners = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def bind(self, server):
+        # IDs are only valid on the Zabbix server they were resolved on
+        with self.lock:
+            if server != self.server:
+                self.entries.clear()
+                self.server = server
+
+    def sync(self, owners):
+        """
+        Keep the entries of owners (public_ip -> router key), the routers of
+        the service now, and drop the others.
+        """
+        with self.lock:
+            for public_ip in list(self.entries):
+                if public_ip not in owners or owners[public_ip] != self.owners.get(public_ip):
+                    del self.entries[public_ip]
+            self.owners = dict(owners)
+
+    def get(self, public_ip, metrics):
+        # (hostid, { metric: itemid }) if every metric is known, otherwise None
+        with self.lock:
+            entry = self.entries.get(public_ip)
+            if entry is None or time.time() - entry[2] > self.ttl \
+                    or any(metric not in entry[1] for metric in metrics):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, public_ip, hostid, itemids):
+        with self.lock:
+            self.entries[public_ip] = (hostid, dict(itemids), time.time())
+
+    def invalidate(self, public_ip=None):
+        with self.lock:
+            if public_ip is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(public_ip, None)
+
 class ICNaaSMonitor(object):
 
-    def __init__(self, maas_endpoint):
+    def __init__(self, maas_endpoint, id_cache=None):
         """
-        Initialize the ICNaaS Monitor object
+        Initialize the ICNaaS Monitor object, id_cache may be shared by the
+        monitors created one after the other for a service
         """
         # Connect to MaaS
         if maas_endpoint is None:
@@ -58,6 +133,8 @@ class ICNaaSMonitor(object):
         self.username = MAAS_UID
         self.password = MAAS_PWD
         self.connFailed = False
+        self.id_cache = id_cache if id_cache is not None else MaaSIdCache()
+        self.id_cache.bind(self.server)
 
         # Zabbix API
         self.zapi = ZabbixAPI(server=self.server)
@@ -95,52 +172,116 @@ class ICNaaSMonitor(object):
                 return
         return measured_values
 
+    def get_all(self, public_ips):
+        """
+        Return { public_ip: { metric: value } } for the given routers, leaving
+        out the ones without a value for every metric.
+        """
+        measured = {}
+        for public_ip in public_ips:
+            values = self.get(public_ip)
+            if values is not None:
+                measured[public_ip] = values
+        return measured
+
     def get_value(self, metric, public_ip):
         raise NotImplementedError
 
 class ICNaaSMonitorCCNRouter(ICNaaSMonitor):
 
-    def __init__(self, maas_endpoint):
-        ICNaaSMonitor.__init__(self, maas_endpoint)
+    def __init__(self, maas_endpoint, id_cache=None):
+        ICNaaSMonitor.__init__(self, maas_endpoint, id_cache)
         self.metrics = [CCN_ROUTER_CPU, CCN_NUMBER_OF_INTERESTS]
 
-    def get_value(self, metric, public_ip):
-        item=""
-
-        if metric == CCN_ROUTER_CPU:
-            item = "system.cpu.util[,idle]"
-
-        if metric == CCN_CACHE_SIZE:
-            item = "ccnx.cache"
-
-        if metric == CCN_CCND_STATUS:
-            item = "proc.num[ccnd]"
-
-        if metric == CCN_CCNR_STATUS:
-            item = "proc.num[ccnr]"
-
-        if metric == CCN_NETWORK_DAEMON_STATUS:
-            item = "net.udp.listen[9695]"
-
-        if metric == CCN_NUMBER_OF_INTERESTS:
-            item = "ccnx.interests"
+    def get(self, public_ip):
+        return self.get_all([public_ip]).get(public_ip)
 
-        if metric == CCN_REPOSITORY_SIZE:
-            item = "ccnx.repository"
+    def get_value(self, metric, public_ip):
+        values = self.get_all([public_ip], [metric]).get(public_ip)
+        if values is not None:
+            return values[metric]
 
-        if metric == CCN_TOTAL_NETWORK_TRAFFIC:
-            item = "net.if.total[eth0]"
+    def get_all(self, public_ips, metrics=None):
+        """
+        Like get for every router, with one item.get by itemid for the
+        routers whose IDs are cached, and for the others one host.get for
+        all IPs and one item.get for all metrics of all hosts.
+        """
+        if metrics is None:
+            metrics = self.metrics
+        public_ips = set(public_ips)
+        measured = {}
+        cached = {}
+        for public_ip in public_ips:
+            ids = self.id_cache.get(public_ip, metrics)
+            if ids is not None:
+                cached[public_ip] = ids
+        if cached:
+            itemids = dict((ids[1][metric], (public_ip, metric))
+                for public_ip, ids in cached.items() for metric in metrics)
+            try:
+                items = self.zapi.item.get({"output":["itemid","lastvalue"],"itemids":sorted(itemids)})
+            except Exception:
+                print "ERROR: User metrics not found"
+                traceback.print_exc()
+                return {}
+            found = {}
+            for item in items:
+                if item["itemid"] in itemids:
+                    public_ip, metric = itemids[item["itemid"]]
+                    found.setdefault(public_ip, {})[metric] = item["lastvalue"]
+            for public_ip in cached:
+                values = found.get(public_ip, {})
+                if len(values) == len(metrics):
+                    measured[public_ip] = values
+                else:
+                    # items or host were recreated, resolve the IDs again
+                    self.id_cache.invalidate(public_ip)
+        unresolved = public_ips - set(measured)
+        if unresolved:
+            measured.update(self.resolve(unresolved, metrics))
+        return measured
 
+    def resolve(self, public_ips, metrics):
+        # hostids and itemids of public_ips, stored in the cache, with the values they returned
         try:
-            hostid = self.zapi.host.get({"filter":{'ip':public_ip}})[0]["hostid"]
-        except:
+            hosts = self.zapi.host.get({"output":["hostid"],"selectInterfaces":["ip"], \
+                "filter":{"ip":sorted(public_ips)}})
+        except Exception:
+            print "ERROR: Hosts of " + ", ".join(sorted(public_ips)) + " not found"
+            traceback.print_exc()
+            return {}
+        hostids = {}
+        for host in hosts:
+            for interface in host.get("interfaces", []):
+                if interface["ip"] in public_ips:
+                    hostids[host["hostid"]] = interface["ip"]
+        for public_ip in public_ips - set(hostids.values()):
             print "WARNING: Public IP " + public_ip + " not found"
-            return
+        if not hostids:
+            return {}
 
+        keys = dict((ITEM_KEYS[metric], metric) for metric in metrics)
         try:
-            value = self.zapi.item.get({"output":"extend","hostids":hostid,"filter":{"key_":item}})[0]["lastvalue"]
-            return value
-        except Exception as e:
-            print "ERROR: User metric not found"
+            items = self.zapi.item.get({"output":["itemid","hostid","key_","lastvalue"], \
+                "hostids":sorted(hostids),"filter":{"key_":sorted(keys)}})
+        except Exception:
+            print "ERROR: User metrics not found"
             traceback.print_exc()
-            
+            return {}
+        found = {}
+        itemids = {}
+        for item in items:
+            public_ip = hostids.get(item["hostid"])
+            if public_ip is not None and item["key_"] in keys:
+                found.setdefault(public_ip, {})[keys[item["key_"]]] = item["lastvalue"]
+                itemids.setdefault(public_ip, {})[keys[item["key_"]]] = item["itemid"]
+        measured = {}
+        for hostid, public_ip in hostids.items():
+            values = found.get(public_ip, {})
+            if len(values) == len(keys):
+                measured[public_ip] = values
+                self.id_cache.put(public_ip, hostid, itemids[public_ip])
+            else:
+                print "ERROR: User metric not found for " + public_ip
+        return measured
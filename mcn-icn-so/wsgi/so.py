@@ -26,12 +26,15 @@ Service Orchestrator for ICNaaS.
 Version 2.0
 """
 
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import os
 import random
 import requests
 import threading
 import time
 
+import icnaas.history
 import icnaas.monitor
 import icnaas.template_generator
 
@@ -58,9 +61,37 @@ CPU_SCALE_OUT_SAFEGUARD = 10
 INTERESTS_SCALE_IN_SAFEGUARD = 5
 INTERESTS_SCALE_OUT_SAFEGUARD = 5
 
+# Routers whose metrics are fetched with one pair of Zabbix queries
+METRICS_BATCH = 50
+# Maximum number of batches collected concurrently
+METRICS_WORKERS = 8
+# Seconds the metrics of one decision tick may take, routers answering later are stale
+METRICS_DEADLINE = 30
+
+# Decide on windowed statistics of the sample history instead of safeguard counters.
+# The safeguards above are then the windows, in samples, a condition has to hold for
+WINDOW_RULES = True
+# Weight of the newest sample in the moving average
+EWMA_ALPHA = 0.3
+# Share of a window, in percent, allowed on the wrong side of a threshold
+WINDOW_TOLERANCE = 20
+# Samples after which a rising moving average above the threshold scales out at once
+SURGE_SAMPLES = 3
+
+# Scale out on interests when their trend reaches the threshold within the provisioning latency
+FORECAST_RULES = True
+# Samples of each of the two consecutive windows the trend is fitted on, and needed in each
+FORECAST_SAMPLES = 6
+FORECAST_MIN_SAMPLES = 4
+# Seconds from a scale out until the new router reports metrics, until one was measured
+PROVISIONING_LATENCY = 600
+
 DEFAULT_METRICS = [icnaas.monitor.CCN_ROUTER_CPU, icnaas.monitor.CCN_NUMBER_OF_INTERESTS]
 DEFAULT_THRESHOLDS = { icnaas.monitor.CCN_ROUTER_CPU: { 'scale_out': 75, 'scale_in': 0 }, \
             icnaas.monitor.CCN_NUMBER_OF_INTERESTS: { 'scale_out': 1500, 'scale_in': 30 } }
+DEFAULT_WINDOWS = { icnaas.monitor.CCN_ROUTER_CPU: { 'scale_out': CPU_SCALE_OUT_SAFEGUARD, \
+            'scale_in': CPU_SCALE_IN_SAFEGUARD }, icnaas.monitor.CCN_NUMBER_OF_INTERESTS: { \
+            'scale_out': INTERESTS_SCALE_OUT_SAFEGUARD, 'scale_in': INTERESTS_SCALE_IN_SAFEGUARD } }
 
 class SOE(service_orchestrator.Execution):
     """
@@ -261,6 +292,17 @@ class SOD(service_orchestrator.Decision, threading.Thread):
         self.event = ready_event
         self.monitor = None
         self.rules_engine = RulesEngine()
+        self.metrics_pool = ThreadPool(METRICS_WORKERS)
+        # Zabbix IDs of the routers, kept across the monitors of successive updates
+        self.maas_ids = icnaas.monitor.MaaSIdCache()
+        self.history = icnaas.history.SampleHistory(DEFAULT_METRICS)
+        # layer -> time of its last scaling, earlier samples do not count for it
+        self.scaled_at = {}
+        # router key -> time its scale out started
+        self.provisioning = {}
+        self.provisioning_latency = PROVISIONING_LATENCY
+        # public_ip -> collection still running after its deadline
+        self.late_metrics = {}
 
     def run(self):
         """
@@ -286,7 +328,7 @@ class SOD(service_orchestrator.Decision, threading.Thread):
                 # Update the information about CCNx routers
                 self.so_e.state()
                 # Then, attempt to connect to MaaS
-                self.monitor = icnaas.monitor.ICNaaSMonitorCCNRouter(self.so_e.maas_endpoint)
+                self.monitor = icnaas.monitor.ICNaaSMonitorCCNRouter(self.so_e.maas_endpoint, self.maas_ids)
                 # Afterwards, keep checking the metrics until service is updated
                 while not self.so_e.updated:
                     self.check_metrics()
@@ -300,18 +342,36 @@ class SOD(service_orchestrator.Decision, threading.Thread):
         # If monitoring is not connected, ignore
         if self.monitor.connFailed:
             return
+        values, stale = self.collect_metrics()
+        if stale:
+            LOG.warning('Metrics of routers ' + ', '.join(stale) + ' missed the deadline, ignoring them')
+        self.history.sync(router['public_ip'] for router in self.so_e.routers.values())
+        self.history.record(time.time(), values)
+        self.measure_provisioning(values)
         # Check metrics for all active routers in each layer
         for layer in self.so_e.layers:
+            if WINDOW_RULES:
+                public_ips = [router['public_ip'] for router in self.so_e.routers.values()
+                    if router['layer'] == layer]
+                times, series = self.history.series(public_ips, self.scaled_at.get(layer))
+                if len(times) == 0:
+                    continue
+                actions = self.rules_engine.process_window(times, series, self.history.metrics,
+                    self.provisioning_latency if FORECAST_RULES else None)
+                if not actions:
+                    self.scale_actions(SCALE_NO_ACTION, layer)
+                else:
+                    self.scale_actions(actions[0], layer, immediate=True)
+                continue
             layer_values = { 'routers_count': 0, 'sum_cpu': 0.0, 'sum_interests': 0 }
             for r in self.so_e.routers:
                 if self.so_e.routers[r]['layer'] != layer:
                     continue
-                if self.so_e.routers[r]['public_ip'] != 'unassigned':
-                    values = self.monitor.get(self.so_e.routers[r]['public_ip'])
-                if values is not None:
+                router_values = values.get(self.so_e.routers[r]['public_ip'])
+                if router_values is not None:
                     layer_values['routers_count'] += 1
-                    layer_values['sum_cpu'] += float(values[icnaas.monitor.CCN_ROUTER_CPU])
-                    layer_values['sum_interests'] += int(values[icnaas.monitor.CCN_NUMBER_OF_INTERESTS])
+                    layer_values['sum_cpu'] += float(router_values[icnaas.monitor.CCN_ROUTER_CPU])
+                    layer_values['sum_interests'] += int(router_values[icnaas.monitor.CCN_NUMBER_OF_INTERESTS])
             if layer_values['routers_count'] > 0:
                 layer_avg = { icnaas.monitor.CCN_ROUTER_CPU: (layer_values['sum_cpu'] / layer_values['routers_count']), \
                     icnaas.monitor.CCN_NUMBER_OF_INTERESTS: (layer_values['sum_interests'] / float(layer_values['routers_count'])) }
@@ -322,7 +382,54 @@ class SOD(service_orchestrator.Decision, threading.Thread):
                     for a in actions:
                         self.scale_actions(a, layer)
 
-    def scale_actions(self, action, layer):
+    def collect_metrics(self):
+        """
+        Get the metrics of all assigned routers, in batches of METRICS_BATCH
+        collected concurrently, waiting at most METRICS_DEADLINE seconds.
+        Returns { public_ip: values } and the routers that are stale, because
+        their batch missed the deadline in this tick or is still running
+        from an earlier one.
+        """
+        deadline = time.time() + METRICS_DEADLINE
+        self.late_metrics = dict((ip, res) for ip, res in self.late_metrics.items() if not res.ready())
+        stale = set(self.late_metrics)
+        owners = dict((router['public_ip'], key) for key, router in self.so_e.routers.items()
+            if router['public_ip'] != 'unassigned')
+        # IDs of routers removed or replaced by scaling are not used again
+        self.maas_ids.sync(owners)
+        public_ips = sorted(set(owners) - stale)
+        pending = []
+        for i in range(0, len(public_ips), METRICS_BATCH):
+            batch = public_ips[i:i + METRICS_BATCH]
+            pending.append((batch, self.metrics_pool.apply_async(self.monitor.get_all, (batch,))))
+        values = {}
+        for batch, res in pending:
+            try:
+                values.update(res.get(max(deadline - time.time(), 0)))
+            except multiprocessing.TimeoutError:
+                # left running, so hanging queries do not take a new worker every tick
+                for public_ip in batch:
+                    self.late_metrics[public_ip] = res
+                stale.update(batch)
+            except Exception as e:
+                LOG.error('Metrics of routers ' + ', '.join(batch) + ' failed: ' + str(e))
+        return values, sorted(stale)
+
+    def measure_provisioning(self, values):
+        # a scale out is complete once its router reports metrics
+        for key, started in self.provisioning.items():
+            router = self.so_e.routers.get(key)
+            if router is None:
+                del self.provisioning[key]
+            elif router['public_ip'] in values:
+                latency = time.time() - started
+                self.provisioning_latency = EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.provisioning_latency
+                LOG.info('Router ' + router['public_ip'] + ' reports metrics ' + str(int(latency)) + \
+                    's after its scale out, expecting ' + str(int(self.provisioning_latency)) + 's')
+                del self.provisioning[key]
+
+    def scale_actions(self, action, layer, immediate=False):
+        # immediate: the action held long enough already, do not count it against the safeguard
         if action == SCALE_NO_ACTION:
             self.so_e.layers[layer]['cpu_scale_in_count'] = 0
             self.so_e.layers[layer]['cpu_scale_out_count'] = 0
@@ -337,7 +444,7 @@ class SOD(service_orchestrator.Decision, threading.Thread):
                 self.so_e.layers[layer]['int_scale_out_count'] = 0
             else:
                 self.so_e.layers[layer]['cpu_scale_out_count'] = 0
-            if count >= (safeguard - 1):
+            if immediate or count >= (safeguard - 1):
                 if action == SCALE_IN_INTERESTS:
                     self.so_e.layers[layer]['int_scale_in_count'] = 0
                 else:
@@ -358,6 +465,7 @@ class SOD(service_orchestrator.Decision, threading.Thread):
                             self.so_e.update()
                             self.so_e.provision()
                             self.so_e.state()
+                            self.scaled_at[layer] = time.time()
                             return
             else:
                 if action == SCALE_IN_INTERESTS:
@@ -374,7 +482,7 @@ class SOD(service_orchestrator.Decision, threading.Thread):
             else:
                 self.so_e.layers[layer]['cpu_scale_in_count'] = 0
             # SCALE OUT
-            if count >= (safeguard - 1):
+            if immediate or count >= (safeguard - 1):
                 if action == SCALE_OUT_INTERESTS:
                     self.so_e.layers[layer]['int_scale_out_count'] = 0
                 else:
@@ -388,9 +496,11 @@ class SOD(service_orchestrator.Decision, threading.Thread):
                 key = max(self.so_e.routers.keys()) + 1
                 self.so_e.routers[key] = { 'public_ip': 'unassigned', 'layer': layer, \
                     'cell_id': cell_id, 'provisioned': False }
+                self.provisioning[key] = time.time()
                 self.so_e.update()
                 self.so_e.provision()
                 self.so_e.state()
+                self.scaled_at[layer] = time.time()
                 return
             else:
                 if action == SCALE_OUT_INTERESTS:
@@ -403,7 +513,7 @@ class RulesEngine(object):
     Rules Engine for Scaling Decisions
     """
 
-    def __init__(self, metrics = None, thresholds = None):
+    def __init__(self, metrics = None, thresholds = None, windows = None):
         if metrics is None:
             self.metrics = DEFAULT_METRICS
         else:
@@ -412,6 +522,10 @@ class RulesEngine(object):
             self.thresholds = DEFAULT_THRESHOLDS
         else:
             self.thresholds = thresholds
+        if windows is None:
+            self.windows = DEFAULT_WINDOWS
+        else:
+            self.windows = windows
 
     def process(self, values):
         actions = []
@@ -434,6 +548,79 @@ class RulesEngine(object):
                 pass
         return actions
 
+    def process_window(self, times, series, columns, horizon=None):
+        """
+        Decide on the layer history, times and a samples x columns array of
+        the metrics in columns, oldest first. A layer scales out when the
+        load stayed above the threshold for the window but for
+        WINDOW_TOLERANCE percent of it, or at once when its moving average
+        crossed the threshold while rising; it scales in when the load
+        stayed below the threshold for the window and is not rising.
+        With a horizon in seconds, a layer also scales out when the trend
+        of its interests reaches the threshold within the horizon.
+        Returns at most one action, see layer_action.
+        """
+        actions = []
+        for metric in self.metrics:
+            if metric not in columns:
+                continue
+            load = series[:, columns.index(metric)]
+            if metric == icnaas.monitor.CCN_ROUTER_CPU:
+                # the CPU metric is the idle time
+                load = 100 - load
+                scale_out, scale_in = SCALE_OUT_CPU, SCALE_IN_CPU
+            elif metric == icnaas.monitor.CCN_NUMBER_OF_INTERESTS:
+                scale_out, scale_in = SCALE_OUT_INTERESTS, SCALE_IN_INTERESTS
+            else:
+                continue
+            load = load[:, None]
+            thresholds = self.thresholds[metric]
+            out_window = self.windows[metric]['scale_out']
+            in_window = self.windows[metric]['scale_in']
+            recent = load[-out_window:]
+            rising = icnaas.history.slope(times[-out_window:], recent)[0] > 0
+            if icnaas.history.valid_count(recent)[0] >= out_window and \
+                    icnaas.history.percentile(recent, WINDOW_TOLERANCE)[0] >= thresholds['scale_out']:
+                actions.append(scale_out)
+            elif icnaas.history.valid_count(load)[0] >= SURGE_SAMPLES and rising \
+                    and load[-1, 0] >= thresholds['scale_out'] \
+                    and icnaas.history.ewma(load, EWMA_ALPHA)[0] >= thresholds['scale_out']:
+                actions.append(scale_out)
+            elif horizon is not None and metric == icnaas.monitor.CCN_NUMBER_OF_INTERESTS \
+                    and self.trend_reaches(times, load, horizon, thresholds['scale_out']):
+                LOG.info('Interests trend reaches the scale out threshold within ' + str(int(horizon)) + 's')
+                actions.append(scale_out)
+            else:
+                recent = load[-in_window:]
+                if icnaas.history.valid_count(recent)[0] >= in_window and \
+                        icnaas.history.percentile(recent, 100 - WINDOW_TOLERANCE)[0] <= thresholds['scale_in'] \
+                        and not icnaas.history.slope(times[-in_window:], recent)[0] > 0:
+                    actions.append(scale_in)
+        return self.layer_action(actions)
+
+    def layer_action(self, actions):
+        """
+        The one action of a layer in a tick among those of its metrics: a
+        scale out if any metric asks for one, a scale in only when none
+        does, as it would remove the router the scale out adds.
+        """
+        for action in actions:
+            if action in (SCALE_OUT_CPU, SCALE_OUT_INTERESTS):
+                return [action]
+        return actions[:1]
+
+    def trend_reaches(self, times, load, horizon, threshold):
+        # both of two consecutive windows have to agree, a single peak is only in one of them
+        target = times[-1] + horizon
+        end = len(times)
+        for start in (end - FORECAST_SAMPLES, end - 2 * FORECAST_SAMPLES):
+            if start < 0 or icnaas.history.valid_count(load[start:end])[0] < FORECAST_MIN_SAMPLES or \
+                    not icnaas.history.forecast(times[start:end], load[start:end], \
+                    target - times[end - 1])[0] >= threshold:
+                return False
+            end = start
+        return True
+
 class ServiceOrchestrator(object):
     """
     ICNaaS SO.
@@ -0,0 +1,102 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@inf.unibe.ch"
+__status__ = "Production"
+
+"""
+Tests of the metric history and its window statistics.
+Version 1.0
+
+    python -m unittest test_history
+"""
+
+import unittest
+
+import numpy
+
+from icnaas import history
+
+NAN = float('nan')
+
+class SampleHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.history = history.SampleHistory(['cpu', 'interests'], window=3, routers=1)
+
+    def record(self, timestamp, **routers):
+        self.history.record(timestamp, dict((ip, { 'cpu': cpu, 'interests': interests })
+            for ip, (cpu, interests) in routers.items()))
+
+    def test_series_mean(self):
+        self.record(1, a=(10, 100), b=(30, 300))
+        self.record(2, a=(20, 200))
+        times, values = self.history.series(['a', 'b'])
+        self.assertEqual(times.tolist(), [1, 2])
+        self.assertEqual(values.tolist(), [[20, 200], [20, 200]])
+        times, values = self.history.series(['b'])
+        self.assertEqual(times.tolist(), [1])
+        self.assertEqual(self.history.series(['c'])[0].tolist(), [])
+
+    def test_window_wraps(self):
+        for tick in range(5):
+            self.record(tick, a=(tick, 10 * tick))
+        times, values = self.history.series(['a'])
+        self.assertEqual(times.tolist(), [2, 3, 4])
+        self.assertEqual(values[:, 1].tolist(), [20, 30, 40])
+        self.assertEqual(self.history.series(['a'], since=2)[0].tolist(), [3, 4])
+
+    def test_sync_reuses_rows(self):
+        self.record(1, a=(1, 1), b=(2, 2), c=(3, 3))
+        self.assertEqual(self.history.samples.shape[0], 4)
+        self.history.sync(['a', 'c'])
+        self.assertEqual(self.history.series(['b'])[0].tolist(), [])
+        self.record(2, d=(4, 4))
+        self.assertEqual(self.history.samples.shape[0], 4)
+        self.assertEqual(self.history.series(['d'])[1].tolist(), [[4, 4]])
+        self.assertEqual(self.history.series(['a'])[0].tolist(), [1])
+
+class StatisticsTest(unittest.TestCase):
+
+    def test_ewma(self):
+        values = numpy.array([[0, 5], [10, 5]], dtype=float)
+        self.assertTrue(numpy.allclose(history.ewma(values, 0.5), [10 / 1.5, 5]))
+        self.assertTrue(numpy.allclose(history.ewma(numpy.array([[10], [NAN]]), 0.5), [10]))
+        self.assertTrue(numpy.isnan(history.ewma(numpy.array([[NAN]]), 0.5)[0]))
+
+    def test_percentile(self):
+        values = numpy.array([[1], [NAN], [3], [2], [100]], dtype=float)
+        self.assertEqual(history.percentile(values, 50).tolist(), [2.5])
+        self.assertEqual(history.percentile(values, 0).tolist(), [1])
+        self.assertTrue(numpy.isnan(history.percentile(numpy.empty((0, 2)), 50)).all())
+
+    def test_slope(self):
+        times = numpy.array([0, 60, 120, 180], dtype=float)
+        values = numpy.array([[0, 5], [120, 5], [NAN, 5], [360, 5]], dtype=float)
+        self.assertTrue(numpy.allclose(history.slope(times, values), [2, 0]))
+        self.assertTrue(numpy.isnan(history.slope(times[:1], values[:1])).all())
+
+    def test_forecast(self):
+        times = numpy.array([0, 60, 120], dtype=float)
+        values = numpy.array([[100], [160], [220]], dtype=float)
+        self.assertTrue(numpy.allclose(history.forecast(times, values, 600), [820]))
+
+if __name__ == '__main__':
+    unittest.main()
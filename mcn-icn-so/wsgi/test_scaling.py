@@ -0,0 +1,95 @@
+#   Copyright (c) 2013-2015, University of Bern, Switzerland.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+__author__ = "Andre Gomes"
+__copyright__ = "Copyright (c) 2013-2015, Mobile Cloud Networking (MCN) project"
+__credits__ = ["Andre Gomes"]
+__license__ = "Apache"
+__version__ = "1.0"
+__maintainer__ = "Andre Gomes"
+__email__ = "gomes@inf.unibe.ch"
+__status__ = "Production"
+
+"""
+Tests of the windowed scaling rules of the SO.
+Version 1.0
+
+    python -m unittest test_scaling
+"""
+
+import unittest
+
+import numpy
+
+import so
+
+# Seconds between two decision ticks
+TICK = 60.0
+
+def decide(interests, horizon=so.PROVISIONING_LATENCY, idle=90):
+    # the layer scaling actions for a history of interests, with idle CPU by default
+    times = numpy.arange(len(interests)) * TICK
+    series = numpy.array([[idle] * len(interests), interests], dtype=float).T
+    return so.RulesEngine().process_window(times, series, so.DEFAULT_METRICS, horizon)
+
+class WindowRulesTest(unittest.TestCase):
+
+    def test_steady_load(self):
+        self.assertEqual(decide([500] * 12, idle=50), [])
+
+    def test_scale_out(self):
+        self.assertEqual(decide([500] * 12, idle=10), [so.SCALE_OUT_CPU])
+        self.assertEqual(decide([2000] * 12), [so.SCALE_OUT_INTERESTS])
+
+    def test_scale_out_tolerates_dip(self):
+        self.assertEqual(decide([2000] * 7 + [100] + [2000] * 4, None), [so.SCALE_OUT_INTERESTS])
+        self.assertEqual(decide([2000] * 8 + [100, 2000, 2000, 100], None), [])
+
+    def test_surge_scales_out(self):
+        self.assertEqual(decide([300] * 6 + [1600, 1800, 2000, 2200], None), [so.SCALE_OUT_INTERESTS])
+
+    def test_scale_in(self):
+        self.assertEqual(decide([5] * 12), [so.SCALE_IN_INTERESTS])
+        self.assertEqual(decide([5] * 10 + [20, 25]), [])
+
+    def test_one_action_per_tick(self):
+        # a scale in would remove the router the scale out adds, two scale outs add two
+        self.assertEqual(decide([5] * 12, idle=10), [so.SCALE_OUT_CPU])
+        self.assertEqual(decide([2000] * 12, idle=10), [so.SCALE_OUT_CPU])
+
+class ForecastTest(unittest.TestCase):
+
+    def test_ramp_scales_out(self):
+        ramp = range(100, 1300, 100)
+        self.assertEqual(decide(ramp), [so.SCALE_OUT_INTERESTS])
+        self.assertEqual(decide(ramp, None), [])
+
+    def test_noisy_ramp_scales_out(self):
+        self.assertEqual(decide([100, 250, 200, 400, 350, 500, 480, 650, 600, 800, 750, 900]),
+            [so.SCALE_OUT_INTERESTS])
+
+    def test_single_spike_does_not_scale_out(self):
+        for age in range(1, 2 * so.FORECAST_SAMPLES + 1):
+            interests = [300] * (2 * so.FORECAST_SAMPLES + 2)
+            interests[-age] = 2000
+            self.assertEqual(decide(interests), [], 'spike %d ticks ago' % (age - 1))
+
+    def test_slow_ramp_does_not_scale_out(self):
+        self.assertEqual(decide(range(100, 220, 10)), [])
+
+    def test_short_history_does_not_scale_out(self):
+        self.assertEqual(decide(range(100, 800, 100)), [])
+
+if __name__ == '__main__':
+    unittest.main()